@@ -0,0 +1,211 @@
+"""An asyncio driver for running simulators as live digital twins.
+
+The reach computations of each simulation step block the calling thread, so
+the driver runs the steps of a simulator's run_iter in an executor and
+publishes each discrete state and continuous segment to asynchronous
+subscribers. One event loop can then supervise many concurrent twins, which
+share a small pool of worker threads."""
+
+import asyncio
+import concurrent.futures
+import threading
+from typing import Any, Dict, List, Optional
+
+from .simulation_framework import Controller
+
+
+_shared_executor : Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+
+def shared_executor() -> concurrent.futures.ThreadPoolExecutor:
+    '''The executor used by drivers which are not given their own.'''
+    global _shared_executor
+    if _shared_executor is None:
+        _shared_executor = concurrent.futures.ThreadPoolExecutor(
+            thread_name_prefix='simulation')
+    return _shared_executor
+
+
+class InjectableController(Controller):
+    '''Wraps a controller so that entries of its discrete state can be
+    overridden while a simulation is running.
+
+    Overrides are sticky: they are applied to every state the controller
+    produces from the next control step on, until they are released. They
+    take effect at the next control step, so the time_step of the run bounds
+    how long an injection can take to act.'''
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.overrides : Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def inject(self, **updates):
+        with self._lock:
+            self.overrides.update(updates)
+
+    def release(self, *keys):
+        '''Stop overriding the given keys (or all keys if none are given).'''
+        with self._lock:
+            if keys:
+                for k in keys:
+                    self.overrides.pop(k, None)
+            else:
+                self.overrides.clear()
+
+    def apply(self, state):
+        with self._lock:
+            if not self.overrides:
+                return state
+            return {**state, **self.overrides}
+
+    def run_iter(self, state=None):
+        gen = self.controller.run_iter(state)
+        yield self.apply(next(gen))
+
+        while True:
+            x = (yield)
+            next(gen)
+            trun, x, state = gen.send(x)
+            yield (trun, x, self.apply(state))
+
+
+class _End:
+    def __init__(self, error: Optional[BaseException] = None):
+        self.error = error
+
+
+class Subscription:
+    '''An asynchronous iterator over the values published by a driver.
+
+    A full queue blocks the driver until the subscriber catches up, unless
+    the subscription is lossy, in which case the oldest queued value is
+    dropped instead.'''
+
+    def __init__(self, maxsize: int = 16, lossy: bool = False):
+        self.queue : asyncio.Queue = asyncio.Queue(maxsize)
+        self.lossy = lossy
+        self.dropped = 0
+
+    async def put(self, v):
+        if self.lossy and self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        await self.queue.put(v)
+
+    async def close(self, error: Optional[BaseException] = None,
+                    drop: bool = False):
+        '''Mark the end of the run, waiting for room in the queue like put
+        does. A lossy subscription, or any subscription if drop is set (e.g.
+        when the run was cancelled), drops queued values to make room
+        instead, as the end of the run must not be dropped.'''
+        if self.lossy or drop:
+            while self.queue.full():
+                self.queue.get_nowait()
+                self.dropped += 1
+        await self.queue.put(_End(error))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        v = await self.queue.get()
+        if isinstance(v, _End):
+            # Stay exhausted on further calls
+            self.queue.put_nowait(v)
+            if v.error is not None:
+                raise v.error
+            raise StopAsyncIteration
+        return v
+
+
+class AsyncSimulationDriver:
+    '''Runs simulator.run_iter(**run_kwargs) one step at a time in an
+    executor, publishing each value it yields to every subscriber.
+
+    The controller of a HybridSimulator is wrapped in an
+    InjectableController, so that inject can change its state mid-run.'''
+
+    def __init__(self, simulator, executor: Optional[concurrent.futures.Executor] = None,
+                 **run_kwargs):
+        self.simulator = simulator
+        self.executor = executor
+        self.run_kwargs = run_kwargs
+        self.subscribers : List[Subscription] = []
+        self.task : Optional[asyncio.Task] = None
+        self.steps = 0
+        controller = getattr(simulator, 'controller', None)
+        if controller is not None and not isinstance(controller,
+                                                     InjectableController):
+            simulator.controller = InjectableController(controller)
+
+    def subscribe(self, maxsize: int = 16, lossy: bool = False) -> Subscription:
+        '''Subscribe to the values published from now on. Must be called
+        from the event loop that runs the driver.'''
+        subscription = Subscription(maxsize, lossy)
+        self.subscribers.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscribers.remove(subscription)
+
+    def inject(self, **updates):
+        '''Override entries of the controller state from the next control
+        step on.'''
+        self.simulator.controller.inject(**updates)
+
+    def release(self, *keys):
+        self.simulator.controller.release(*keys)
+
+    async def _publish(self, v):
+        for subscription in list(self.subscribers):
+            await subscription.put(v)
+
+    async def run(self):
+        '''Run the simulation to completion (or until cancelled).'''
+        executor = (self.executor if self.executor is not None
+                    else shared_executor())
+        gen = self.simulator.run_iter(**self.run_kwargs)
+        end = _End()
+        step = None
+        cancelled = False
+        try:
+            while True:
+                step = executor.submit(next, gen, end)
+                v = await asyncio.wrap_future(step)
+                if v is end:
+                    break
+                self.steps += 1
+                await self._publish(v)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        except Exception as e:
+            end.error = e
+        finally:
+            if step is not None and not step.done():
+                # The generator cannot be closed while a step is running in
+                # the executor, so close it once the step completes
+                step.add_done_callback(lambda _: gen.close())
+            else:
+                gen.close()
+            # A cancelled run must not wait for slow subscribers
+            for subscription in list(self.subscribers):
+                await subscription.close(end.error, drop=cancelled)
+
+        if end.error is not None:
+            raise end.error
+
+    def start(self) -> asyncio.Task:
+        '''Start running the simulation as a task on the running loop.'''
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return self.task
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    @property
+    def done(self) -> bool:
+        return self.task is not None and self.task.done()
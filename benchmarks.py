@@ -0,0 +1,226 @@
+"""Reproducible benchmarks of the incubator models, simulators and monitoring.
+
+Run from the directory containing the package with e.g.
+
+    python -m package.benchmarks --output results.json
+    python -m package.benchmarks --baseline results.json
+
+to write machine readable results, or to compare against (and fail on
+regressions from) an earlier set of results.
+
+The scenarios do not yet cover:
+
+- numerical runs of the switching models, whose per-mode models are always
+  IntervalParametricModels, and
+- signal array runs of the fixed models, as SignalArraySwitchedController
+  needs the time as a state variable, which those models lack."""
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from sage.all import RIF, QQ
+from sage.version import version as sage_version
+
+from .controllers import PeriodicOpenLoopController, SignalArraySwitchedController
+from .incubator_models import (twopincubator, fourpincubator, sevenpincubator,
+                               SwitchingFourParameterModel,
+                               SwitchingFourParameterModelCAGB, T_S, T_A)
+from .lbuc import Atomic
+from .parametric_models import NumericalParametricModel
+from .simulators import HybridSimulator
+from .subdivision import final_width
+from .traces import is_numerical_segment
+
+
+def numerical_model(model) -> NumericalParametricModel:
+    '''The numerical (QQ) counterpart of an IntervalParametricModel, taking
+    the midpoints of its intervals.'''
+    return NumericalParametricModel(
+        ','.join(model.vs),
+        [QQ(x.center()) for x in model.T0s],
+        model.Ts,
+        {k: QQ(v.center()) for k, v in model.params.items()},
+    )
+
+
+def periodic_controller():
+    return PeriodicOpenLoopController(RIF("3.0"), 20, 3)
+
+
+def signal_array_controller():
+    # A synthetic actuation log switching the heater on for 9s every 60s
+    timepoints = np.arange(0.0, 3600.0, 3.0)
+    heater_on = (timepoints % 60.0) < 9.0
+    return SignalArraySwitchedController({'heater_on': False}, timepoints,
+                                         {'heater_on': heater_on})
+
+
+def signal_array_simulator(model):
+    # The controller reads and passes through the time variable t
+    return HybridSimulator(model, signal_array_controller(),
+                           controller_input_map=(lambda x: x[0]),
+                           controller_output_map=(lambda xin, x: xin))
+
+
+SWITCHING_X0 = [RIF("0"), RIF("[21.0, 21.05]"), RIF("25.0")]
+SWITCHING_CAGB_X0 = SWITCHING_X0 + [RIF("[68.0, 68.4]"), RIF("[0.73, 0.74]")]
+
+
+# Benchmark scenarios by name (see the module docstring for the gaps)
+SCENARIOS : Dict[str, Callable[[], HybridSimulator]] = {
+    **{
+        f"{name}/periodic/{mode}": (
+            lambda model=model, mode=mode: HybridSimulator(
+                model if mode == 'verified' else numerical_model(model),
+                periodic_controller(),
+            )
+        )
+        for name, model in [('twopincubator', twopincubator),
+                            ('fourpincubator', fourpincubator),
+                            ('sevenpincubator', sevenpincubator)]
+        for mode in ['verified', 'numerical']
+    },
+    "SwitchingFourParameterModel/periodic/verified": lambda: HybridSimulator(
+        SwitchingFourParameterModel(SWITCHING_X0), periodic_controller()),
+    "SwitchingFourParameterModel/signal_array/verified": lambda:
+        signal_array_simulator(SwitchingFourParameterModel(SWITCHING_X0)),
+    "SwitchingFourParameterModelCAGB/periodic/verified": lambda: HybridSimulator(
+        SwitchingFourParameterModelCAGB(SWITCHING_CAGB_X0),
+        periodic_controller()),
+    "SwitchingFourParameterModelCAGB/signal_array/verified": lambda:
+        signal_array_simulator(
+            SwitchingFourParameterModelCAGB(SWITCHING_CAGB_X0)),
+}
+
+
+def run_scenario(name: str, time_limit: RIF, memory: bool) -> Dict[str, Any]:
+    simulator = SCENARIOS[name]()
+    if memory:
+        tracemalloc.start()
+
+    step_times : List[float] = []
+    values = []
+    start = time.perf_counter()
+    run = simulator.run_iter(time_limit=time_limit)
+    while True:
+        step_start = time.perf_counter()
+        try:
+            v = next(run)
+        except StopIteration:
+            break
+        if not isinstance(v, dict) or is_numerical_segment(v):
+            step_times.append(time.perf_counter() - step_start)
+        values.append(v)
+    wall_time = time.perf_counter() - start
+
+    result : Dict[str, Any] = {
+        'wall_time': wall_time,
+        'reach_steps': len(step_times),
+        'reach_step_time_mean': (statistics.mean(step_times)
+                                 if step_times else None),
+        'reach_step_time_max': max(step_times, default=None),
+        'peak_memory': (tracemalloc.get_traced_memory()[1]
+                        if memory else None),
+    }
+    if memory:
+        tracemalloc.stop()
+
+    trace = simulator.TraceType(RIF(0, time_limit), values)
+    result['segments'] = len(trace.continuous_part.values)
+    result['final_width'] = final_width(trace)
+
+    if result['final_width'] is not None:
+        monitor_start = time.perf_counter()
+        # Check that the air (or, for the two parameter model, the
+        # incubator) stays below 30 degrees
+        temperature = T_S if name.startswith('twopincubator') else T_A
+        Atomic(30 - temperature).signal(trace)
+        result['monitor_time'] = time.perf_counter() - monitor_start
+    else:
+        result['monitor_time'] = None
+
+    return result
+
+
+def run_benchmarks(names: List[str], time_limit: RIF, repeat: int,
+                   memory: bool) -> Dict[str, Any]:
+    results = {}
+    for name in names:
+        runs = [run_scenario(name, time_limit, memory) for _ in range(repeat)]
+        # Report the fastest run, which is the least perturbed by noise
+        results[name] = min(runs, key=lambda r: r['wall_time'])
+        print(f"{name}: {results[name]['wall_time']:.3f}s, "
+              f"{results[name]['segments']} segments", file=sys.stderr)
+
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'sage': sage_version,
+            'machine': platform.machine(),
+        },
+        'time_limit': float(time_limit.upper()),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any],
+            tolerance: float) -> List[str]:
+    '''Describe each timing which has regressed by more than the given
+    relative tolerance compared to the baseline.'''
+    regressions = []
+    for name, result in results['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        for metric in ['wall_time', 'reach_step_time_mean', 'monitor_time',
+                       'peak_memory']:
+            new, old = result.get(metric), base.get(metric)
+            if new is not None and old and new > old*(1 + tolerance):
+                regressions.append(
+                    f"{name}: {metric} {old:.4g} -> {new:.4g} "
+                    f"(+{100*(new/old - 1):.0f}%)")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS),
+                        help="scenarios to run (default: all)")
+    parser.add_argument('--time-limit', type=float, default=120.0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--memory', action='store_true',
+                        help="measure peak memory (slows down the runs)")
+    parser.add_argument('--output', help="file to write JSON results to")
+    parser.add_argument('--baseline', help="JSON results to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="relative slowdown counted as a regression")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.scenarios, RIF(args.time_limit),
+                             args.repeat, args.memory)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
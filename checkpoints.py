@@ -0,0 +1,142 @@
+"""Checkpointing the state of long running hybrid simulations to disk.
+
+The values produced by a run are appended to a segment log next to the
+checkpoint as they are produced, and each checkpoint only records how much
+of the log it covers, so that checkpointing does not rewrite the trace."""
+
+import os
+import pickle
+import time
+from typing import Any, Dict, IO, Iterator, Optional
+
+from sage.all import RIF
+
+from .traces import picklable_segment
+
+
+class SimulationState:
+    '''The complete state of a hybrid simulation between two control steps:
+    the current time, the continuous state box, the discrete controller
+    state and the number of values of the trace produced so far, which are
+    held in the segment log at log_path up to log_offset.'''
+
+    def __init__(self, t: RIF, x: list, state: Dict[str, Any],
+                 log_path: Optional[str] = None, log_offset: int = 0,
+                 n_segments: int = 0):
+        self.t = t
+        self.x = x
+        self.state = state
+        self.log_path = log_path
+        self.log_offset = log_offset
+        self.n_segments = n_segments
+
+    @property
+    def segments(self) -> Iterator[Any]:
+        '''Read the values of the trace produced so far from the log.'''
+        if self.log_path is None:
+            return
+        with open(self.log_path, 'rb') as f:
+            while f.tell() < self.log_offset:
+                yield pickle.load(f)
+
+    def __repr__(self):
+        return (f"SimulationState(t={self.t.str(style='brackets')}, "
+                f"state={self.state}, {self.n_segments} segments)")
+
+
+def save_checkpoint(path: str, sim_state: SimulationState):
+    # Write atomically so that a crash mid-write leaves the last checkpoint
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(sim_state, f)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path: str) -> SimulationState:
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+class Checkpointer:
+    '''Periodically saves the state of a running simulation to path, every
+    every_steps control steps and/or every_seconds of wall time.
+
+    Unless keep_segments is False, the values of the run are appended to the
+    segment log path.segments, so that a resumed run can include the trace
+    produced before the checkpoint. Segments which cannot be pickled are
+    logged as boxes enclosing them over steps of at most resolution
+    seconds.'''
+
+    def __init__(self, path: str, every_steps: Optional[int] = None,
+                 every_seconds: Optional[float] = None,
+                 keep_segments: bool = True,
+                 resolution: Optional[float] = 0.5):
+        self.path = path
+        self.every_steps = every_steps
+        self.every_seconds = every_seconds
+        self.keep_segments = keep_segments
+        self.resolution = resolution
+        self.log_path = f"{path}.segments"
+        self._log : Optional[IO[bytes]] = None
+        self.n_segments = 0
+        self._steps_since_save = 0
+        self._last_save = time.monotonic()
+
+    def _open_log(self) -> IO[bytes]:
+        if self._log is None:
+            self._log = open(self.log_path, 'wb')
+        return self._log
+
+    def continue_from(self, sim_state: SimulationState):
+        '''Continue the segment log of the run saved in sim_state, so that
+        checkpoints of a resumed run cover the whole trace.'''
+        if not self.keep_segments:
+            return
+        if (sim_state.log_path is not None
+                and os.path.abspath(sim_state.log_path)
+                    == os.path.abspath(self.log_path)):
+            # Discard anything logged after the checkpoint
+            self._log = open(self.log_path, 'r+b')
+            self._log.truncate(sim_state.log_offset)
+            self._log.seek(sim_state.log_offset)
+            self.n_segments = sim_state.n_segments
+        else:
+            for v in sim_state.segments:
+                self.record(v)
+
+    def record(self, v):
+        '''Record a value yielded by the simulation.'''
+        if self.keep_segments:
+            pickle.dump(picklable_segment(v, self.resolution),
+                        self._open_log())
+            self.n_segments += 1
+        return v
+
+    def step(self, t: RIF, x: list, state: Dict[str, Any], force=False):
+        '''Notify the checkpointer that a control step has completed.'''
+        self._steps_since_save += 1
+        if (force
+                or (self.every_steps is not None
+                    and self._steps_since_save >= self.every_steps)
+                or (self.every_seconds is not None
+                    and time.monotonic() - self._last_save
+                        >= self.every_seconds)):
+            if self.keep_segments:
+                log = self._open_log()
+                log.flush()
+                os.fsync(log.fileno())
+                log_path, log_offset = self.log_path, log.tell()
+            else:
+                log_path, log_offset = None, 0
+            save_checkpoint(
+                self.path,
+                SimulationState(t, list(x), dict(state), log_path, log_offset,
+                                self.n_segments),
+            )
+            self._steps_since_save = 0
+            self._last_save = time.monotonic()
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
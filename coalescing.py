@@ -0,0 +1,143 @@
+"""Online coalescing of the continuous segments of verified hybrid runs.
+
+Many segments of a hybrid run are very short (e.g. heating pulses), and
+every consumer of a trace pays per segment. coalesce_segments is a pipeline
+stage between a simulator and its trace which replaces runs of consecutive
+segments with a single box enclosing all of them, whenever doing so widens
+the enclosure of each segment by no more than a width budget."""
+
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sage.all import RIF
+
+from .traces import ReachSegment, is_numerical_segment
+
+
+class CoalescedSegment(ReachSegment):
+    '''A segment made of a run of consecutive segments, which encloses the
+    state over any time within it by the hull of the whole run, except at
+    the end, where it gives the final state of the run.
+
+    The discrete states entered during the run are kept in events, together
+    with their offsets from the start of the segment. In a trace, these
+    states precede the segment, and HybridTrace uses their offsets to find
+    the state in force at each time.'''
+
+    def __init__(self, vs: List[str], time: RIF, hull: List[RIF],
+                 end: List[RIF], events: List[Tuple[RIF, Dict[str, Any]]],
+                 n_segments: int):
+        self.vs = vs
+        self.time = time
+        self.hull = hull
+        self.end = end
+        self.events = events
+        self.n_segments = n_segments
+
+    def __call__(self, t) -> List[RIF]:
+        t = RIF(t)
+        if t.lower() >= self.time.upper():
+            return list(self.end)
+        return list(self.hull)
+
+    def state_at(self, t) -> Optional[Dict[str, Any]]:
+        '''The discrete state entered last at or before the local time t
+        within the segment, if any was entered during it.'''
+        state = None
+        for offset, s in self.events:
+            if offset.lower() <= RIF(t).upper():
+                state = s
+        return state
+
+
+class _Run:
+    '''A run of segments being considered for coalescing, together with the
+    discrete states which precede and separate them.'''
+
+    def __init__(self):
+        self.values : List[Any] = []
+        self.events : List[Tuple[RIF, Dict[str, Any]]] = []
+        self.n_segments = 0
+        self.time = RIF(0)
+        self.hull : Optional[List[RIF]] = None
+        self.min_widths : Optional[List[float]] = None
+        self.end : Optional[List[RIF]] = None
+
+    def add_state(self, state: Dict[str, Any]):
+        self.values.append(state)
+        self.events.append((self.time, state))
+
+    @staticmethod
+    def growth(hull: List[RIF], min_widths: List[float]) -> float:
+        return max((float(x.absolute_diameter()) - w
+                    for x, w in zip(hull, min_widths)), default=0.0)
+
+    def try_add(self, r, box: List[RIF], width_budget: float) -> bool:
+        '''Add the segment r enclosed by box, unless this would widen the
+        enclosure of some segment of the run by more than width_budget.'''
+        widths = [float(x.absolute_diameter()) for x in box]
+        if self.hull is None:
+            hull, min_widths = list(box), widths
+        else:
+            hull = [x.union(y) for x, y in zip(self.hull, box)]
+            min_widths = [min(a, b) for a, b in zip(self.min_widths, widths)]
+            if self.growth(hull, min_widths) > width_budget:
+                return False
+        self.hull, self.min_widths = hull, min_widths
+        self.values.append(r)
+        self.n_segments += 1
+        self.time += RIF(r.time)
+        self.end = list(r(r.time))
+        return True
+
+    def take_pending(self) -> List[Dict[str, Any]]:
+        '''Remove and return the states entered since the last segment.'''
+        pending = []
+        while self.values and isinstance(self.values[-1], dict):
+            pending.insert(0, self.values.pop())
+            self.events.pop()
+        return pending
+
+    def flush(self):
+        '''The values replacing the run: the run itself unless it contains
+        several segments, in which case its discrete states followed by a
+        single CoalescedSegment.'''
+        if self.n_segments < 2:
+            yield from self.values
+            return
+        for _, state in self.events:
+            yield state
+        first = next(v for v in self.values if not isinstance(v, dict))
+        yield CoalescedSegment(list(first.vs), self.time, self.hull, self.end,
+                               self.events, self.n_segments)
+
+
+def coalesce_segments(values: Iterable[Any], width_budget: float,
+                      max_segments: Optional[int] = None):
+    '''Coalesce the segments of a verified hybrid run (or trace) online.
+
+    A run of segments is emitted once the next segment cannot be added to it
+    within the budget, or once it contains max_segments segments, which
+    bounds how long values are held back. Numerical segments are passed
+    through unchanged.'''
+    run = _Run()
+    for v in values:
+        if isinstance(v, dict) and not is_numerical_segment(v):
+            run.add_state(v)
+            continue
+        if is_numerical_segment(v):
+            yield from run.flush()
+            run = _Run()
+            yield v
+            continue
+
+        box = v(RIF(0, v.time))
+        if ((max_segments is not None and run.n_segments >= max_segments)
+                or not run.try_add(v, box, width_budget)):
+            # The states entered since the last segment precede the new run
+            pending = run.take_pending()
+            yield from run.flush()
+            run = _Run()
+            for state in pending:
+                run.add_state(state)
+            run.try_add(v, box, width_budget)
+    yield from run.flush()
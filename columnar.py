@@ -0,0 +1,310 @@
+"""Compact columnar storage of numerical hybrid traces.
+
+A ColumnarNumericalTrace keeps the segment boundaries, sampled times and
+sampled states of a numerical run in contiguous NumPy arrays, and the
+discrete states in a separate table of array-encoded columns, rather than
+an OdeSolution and a dict per segment. It can be saved as a single .npz
+file, or as a directory of .npy files which are memory mapped on loading."""
+
+import enum
+import json
+import os
+from functools import partial
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy.integrate import OdeSolution
+from sage.all import RIF
+import sage.all as sg
+
+from .traces import (DiscreteTrace, RealTimeTrace, dense_output,
+                     evaluate_dense_output, evaluate_segments,
+                     is_numerical_segment)
+
+
+_ARRAYS = ['boundaries', 'segment_offsets', 'times', 'states', 'event_times',
+           'event_segments']
+
+
+def encode_column(values: Sequence[Any]) -> Tuple[np.ndarray, Dict[str, Any]]:
+    '''Encode the values of one entry of the discrete states as an array,
+    together with the metadata needed to decode it. Booleans and numbers are
+    stored directly and anything else (e.g. enums) as integer codes.'''
+    if values and all(isinstance(v, (bool, np.bool_)) for v in values):
+        return np.array(values, dtype=bool), {'kind': 'bool'}
+    if values and all(isinstance(v, (int, np.integer))
+                      and not isinstance(v, (bool, np.bool_))
+                      for v in values):
+        return np.array(values, dtype=np.int64), {'kind': 'int'}
+    if values and all(isinstance(v, (float, np.floating)) for v in values):
+        return np.array(values, dtype=float), {'kind': 'float'}
+
+    categories : List[Any] = []
+    codes = np.empty(len(values), dtype=np.int32)
+    for i, v in enumerate(values):
+        if v not in categories:
+            categories.append(v)
+        codes[i] = categories.index(v)
+    enum_type = next((type(v) for v in categories if isinstance(v, enum.Enum)),
+                     None)
+    return codes, {
+        'kind': 'categorical',
+        'enum': (None if enum_type is None
+                 else f"{enum_type.__module__}.{enum_type.__qualname__}"),
+        'categories': [v.name if isinstance(v, enum.Enum) else v
+                       for v in categories],
+    }
+
+
+def decode_categories(meta: Dict[str, Any], enum_type=None) -> List[Any]:
+    if enum_type is None:
+        return list(meta['categories'])
+    return [None if name is None else enum_type[name]
+            for name in meta['categories']]
+
+
+class ColumnarNumericalTrace:
+    '''A numerical hybrid (or continuous) trace stored as arrays.
+
+    Segment k spans boundaries[k] to boundaries[k + 1] and its samples are
+    times[segment_offsets[k]:segment_offsets[k + 1]] and the corresponding
+    rows of states. Discrete state i was entered at event_times[i], before
+    segment event_segments[i]. Between samples the states are interpolated
+    linearly, unless the dense output of each segment was kept.'''
+
+    def __init__(self, boundaries, segment_offsets, times, states,
+                 event_times, event_segments,
+                 discrete_columns: Dict[str, np.ndarray],
+                 discrete_meta: Dict[str, Dict[str, Any]],
+                 domain: Optional[RIF] = None,
+                 dense_outputs: Optional[List[OdeSolution]] = None,
+                 enum_types: Optional[Dict[str, type]] = None):
+        self.boundaries = boundaries
+        self.segment_offsets = segment_offsets
+        self.times = times
+        self.states = states
+        self.event_times = event_times
+        self.event_segments = event_segments
+        self.discrete_columns = discrete_columns
+        self.discrete_meta = discrete_meta
+        self._domain = domain
+        self.dense_outputs = dense_outputs
+        enum_types = enum_types or {}
+        self._categories = {
+            k: decode_categories(meta, enum_types.get(k))
+            for k, meta in discrete_meta.items()
+            if meta['kind'] == 'categorical'
+        }
+
+    @classmethod
+    def from_values(cls, values: Iterable[Any], start_time=0.0,
+                    domain: Optional[RIF] = None, keep_dense_output=False,
+                    sample_step: Optional[float] = None,
+                    enum_types: Optional[Dict[str, type]] = None
+                    ) -> 'ColumnarNumericalTrace':
+        '''Convert the values of a numerical run (e.g. from run_iter or a
+        NumericalHybridTrace), which need not fit in memory at once.
+
+        Each segment is sampled at the steps taken by the solver, or every
+        sample_step seconds. The dense output is only kept if
+        keep_dense_output is set.'''
+        t = float(RIF(start_time).lower())
+        boundaries, offsets = [t], [0]
+        times : List[np.ndarray] = []
+        states : List[np.ndarray] = []
+        event_times : List[float] = []
+        event_segments : List[int] = []
+        discrete : List[dict] = []
+        sols : List[OdeSolution] = []
+        n_samples = 0
+
+        for v in values:
+            if not is_numerical_segment(v):
+                event_times.append(t)
+                event_segments.append(len(boundaries) - 1)
+                discrete.append(v)
+                continue
+
+            sol = dense_output(v)
+            if sample_step is not None or not hasattr(v, 'y'):
+                # A bare OdeSolution is sampled at the solver's steps
+                local_ts = (np.append(np.arange(sol.t_min, sol.t_max,
+                                                sample_step), sol.t_max)
+                            if sample_step is not None
+                            else np.asarray(sol.ts, dtype=float))
+                ys = np.reshape(sol(local_ts), (-1, len(local_ts))).T
+            else:
+                local_ts = np.asarray(v.t, dtype=float)
+                ys = np.asarray(v.y, dtype=float).T
+            times.append(t + local_ts - local_ts[0])
+            states.append(ys)
+            n_samples += len(local_ts)
+            offsets.append(n_samples)
+            t += float(local_ts[-1] - local_ts[0])
+            boundaries.append(t)
+            if keep_dense_output:
+                sols.append(sol)
+
+        keys = list(dict.fromkeys(k for state in discrete for k in state))
+        discrete_columns, discrete_meta = {}, {}
+        # Decode enums to the types they were encoded from
+        enum_types = dict(enum_types or {})
+        for k in keys:
+            column = [state.get(k) for state in discrete]
+            discrete_columns[k], discrete_meta[k] = encode_column(column)
+            for v in column:
+                if isinstance(v, enum.Enum):
+                    enum_types.setdefault(k, type(v))
+                    break
+
+        return cls(
+            np.array(boundaries),
+            np.array(offsets, dtype=np.int64),
+            np.concatenate(times) if times else np.empty(0),
+            np.concatenate(states) if states else np.empty((0, 0)),
+            np.array(event_times),
+            np.array(event_segments, dtype=np.int64),
+            discrete_columns, discrete_meta,
+            domain=domain,
+            dense_outputs=sols if keep_dense_output else None,
+            enum_types=enum_types,
+        )
+
+    @classmethod
+    def from_trace(cls, trace: RealTimeTrace, **kwargs
+                   ) -> 'ColumnarNumericalTrace':
+        '''Convert a NumericalHybridTrace or NumericalContinuousTrace,
+        consuming it as it goes if it is streamed.'''
+        return cls.from_values(trace, start_time=trace.retained_start,
+                               domain=trace.domain, **kwargs)
+
+    @property
+    def domain(self) -> RIF:
+        if self._domain is not None:
+            return self._domain
+        return RIF(self.boundaries[0], self.boundaries[-1])
+
+    @property
+    def n_segments(self) -> int:
+        return len(self.boundaries) - 1
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in self._arrays().values())
+
+    def segment(self, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        '''The sampled times and states of segment k (as views).'''
+        a, b = self.segment_offsets[k], self.segment_offsets[k + 1]
+        return self.times[a:b], self.states[a:b]
+
+    def _interpolate_segment(self, k: int, ts: np.ndarray) -> np.ndarray:
+        seg_ts, seg_ys = self.segment(k)
+        return np.stack([np.interp(ts, seg_ts, seg_ys[:, i])
+                         for i in range(seg_ys.shape[1])], axis=1)
+
+    def evaluate(self, ts) -> np.ndarray:
+        '''The states at each of the absolute times ts as an array of shape
+        (n_times, n_vars), which is NaN outside of the trace.'''
+        n_vars = self.states.shape[1] if self.states.ndim == 2 else 0
+        return evaluate_segments(
+            ts, self.boundaries, n_vars,
+            (partial(evaluate_dense_output, self.dense_outputs,
+                     self.boundaries)
+             if self.dense_outputs is not None
+             else self._interpolate_segment),
+        )
+
+    def __call__(self, t) -> Optional[np.ndarray]:
+        if t not in self.domain:
+            return None
+
+        y = self.evaluate([t])[0]
+        return None if np.isnan(y).all() else y
+
+    def _decode(self, k: str, i: int):
+        v = self.discrete_columns[k][i]
+        if k in self._categories:
+            return self._categories[k][v]
+        return v.item()
+
+    def discrete_state(self, i: int) -> Dict[str, Any]:
+        return {k: self._decode(k, i) for k in self.discrete_columns}
+
+    def state_at(self, t) -> Optional[Dict[str, Any]]:
+        '''The discrete state in force at time t (the last one entered at
+        or before t).'''
+        i = np.searchsorted(self.event_times, float(t), side='right') - 1
+        return None if i < 0 else self.discrete_state(i)
+
+    @property
+    def discrete_part(self) -> DiscreteTrace:
+        return DiscreteTrace(self.discrete_state(i)
+                             for i in range(len(self.event_times)))
+
+    def plot(self, variables: Tuple[int], **kwargs) -> 'sg.Graphics':
+        g = sg.Graphics()
+        for k in range(self.n_segments):
+            seg_ts, seg_ys = self.segment(k)
+            for i in variables:
+                g += sg.line(zip(seg_ts, seg_ys[:, i]), **kwargs)
+        return g
+
+    def _arrays(self) -> Dict[str, np.ndarray]:
+        arrays = {name: getattr(self, name) for name in _ARRAYS}
+        arrays.update({f"discrete_{i}": self.discrete_columns[k]
+                       for i, k in enumerate(self.discrete_columns)})
+        return arrays
+
+    def _meta(self) -> Dict[str, Any]:
+        return {
+            'domain': [float(self.domain.lower()), float(self.domain.upper())],
+            'discrete': [[k, self.discrete_meta[k]]
+                         for k in self.discrete_columns],
+        }
+
+    def save(self, path: str):
+        '''Save to a .npz file if path ends in .npz, or otherwise to a
+        directory of .npy files. Dense output is not saved.'''
+        arrays = self._arrays()
+        meta = json.dumps(self._meta())
+        if path.endswith('.npz'):
+            np.savez(path, meta=np.array(meta), **arrays)
+            return
+
+        os.makedirs(path, exist_ok=True)
+        for name, a in arrays.items():
+            np.save(os.path.join(path, f"{name}.npy"), a)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            f.write(meta)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: Optional[str] = 'r',
+             enum_types: Optional[Dict[str, type]] = None
+             ) -> 'ColumnarNumericalTrace':
+        '''Load a saved trace. The arrays of a saved directory are memory
+        mapped (unless mmap_mode is None), so nothing is read until used,
+        whereas those of a .npz file are read into memory.
+
+        Enum valued discrete states are decoded to their names unless their
+        types are given in enum_types.'''
+        if path.endswith('.npz'):
+            npz = np.load(path)
+            meta = json.loads(str(npz['meta']))
+            arrays = {name: npz[name] for name in npz.files if name != 'meta'}
+        else:
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+            arrays = {
+                name[:-len('.npy')]: np.load(os.path.join(path, name),
+                                             mmap_mode=mmap_mode)
+                for name in os.listdir(path) if name.endswith('.npy')
+            }
+
+        keys = [k for k, _ in meta['discrete']]
+        return cls(
+            *(arrays[name] for name in _ARRAYS),
+            {k: arrays[f"discrete_{i}"] for i, k in enumerate(keys)},
+            {k: m for k, m in meta['discrete']},
+            domain=RIF(*meta['domain']),
+            enum_types=enum_types,
+        )
@@ -1,7 +1,11 @@
+import bisect
+
+import numpy as np
 from sage.all import RIF
 
 from enum import Enum, auto
 
+from .live_inputs import SampleRing
 from .simulation_framework import Controller
 
 
@@ -12,9 +16,10 @@ class BasicController(Controller):
     def control_step(self, x, state):
         raise NotImplementedError("Control step needs to be implemented")
     
-    def run_iter(self):
+    def run_iter(self, state=None):
         x = None
-        state = self.initial_state
+        if state is None:
+            state = self.initial_state
         
         yield state
         
@@ -29,9 +34,30 @@ class TrivialController(BasicController):
         return RIF("Inf"), x, state
     
     
+class SignalIndex:
+    '''A sorted index of the (domain, value) segments of a signal.'''
+
+    def __init__(self, signal):
+        self.values = sorted(signal.values, key=lambda dv: dv[0].lower())
+        self.lowers = [float(d.lower()) for d, _ in self.values]
+        self.uppers = [float(d.upper()) for d, _ in self.values]
+
+    def active(self, t: float):
+        '''The segment which is active at time t, which at the boundary
+        between two segments is the later one. Falls back to the last segment
+        if no segment is active.'''
+        k = bisect.bisect_right(self.lowers, t) - 1
+        if k >= 0 and t < self.uppers[k]:
+            return self.values[k]
+        return self.values[-1]
+
+
 class SignalSwitchedController(BasicController):
     def __init__(self, initial_state, input_signals: dict):
         self.input_signals = input_signals
+        self.signal_indices = {
+            k: SignalIndex(s) for k, s in input_signals.items()
+        }
         super().__init__(initial_state)
     
     def control_step(self, x, state):
@@ -39,12 +65,8 @@ class SignalSwitchedController(BasicController):
         
         output_state = dict(**state)
         run_duration = RIF("Inf")
-        for k, s in self.input_signals.items():
-            try:
-                # FIXME: dirty hack to find the edge of the domain which the current timepoint belongs in
-                current_domain, output_state[k] = next((d, v) for d, v in s.values if (t+RIF("0.5")).overlaps(d))
-            except StopIteration:
-                current_domain, output_state[k] = s.values[-1]
+        for k, index in self.signal_indices.items():
+            current_domain, output_state[k] = index.active(float(t.upper()))
             run_duration = min(run_duration, current_domain.edges()[1] - t)
         
         return (run_duration, x, output_state)
@@ -69,66 +91,129 @@ class SignalFnSwitchedController(BasicController):
 
 class SignalArraySwitchedController(BasicController):
     def __init__(self, initial_state, timepoints, input_signals_arrays: dict):
-        self.timepoints = timepoints
-        self.input_signals_arrays = input_signals_arrays
+        # np.asarray does not copy memory mapped arrays
+        self.timepoints = np.asarray(timepoints)
+        self.input_signals_arrays = {
+            k: np.asarray(sig_arr)
+            for k, sig_arr in input_signals_arrays.items()
+        }
+        self.change_points = {
+            k: self.signal_change_points(sig_arr)
+            for k, sig_arr in self.input_signals_arrays.items()
+        }
         super().__init__(initial_state)
 
-    @staticmethod
-    def next_signal_change(t0, v0, ts, vs):
-        for (t, v) in zip(ts, vs):
-            if t >= t0 and v != v0:
-                return t, v
-
-        return None
+    @classmethod
+    def from_npy(cls, initial_state, timepoints_path, input_signals_paths: dict):
+        '''Replay signals saved in .npy files, which are memory mapped rather
+        than loaded into memory.'''
+        return cls(
+            initial_state,
+            np.load(timepoints_path, mmap_mode='r'),
+            {
+                k: np.load(path, mmap_mode='r')
+                for k, path in input_signals_paths.items()
+            },
+        )
 
     @staticmethod
-    def current_signal_state(t0, v0, ts, vs):
-        v_current = v0
+    def signal_change_points(sig_arr):
+        '''The indices of the samples at which a signal changes value.'''
+        return np.flatnonzero(sig_arr[1:] != sig_arr[:-1]) + 1
 
-        for (t, v) in zip(ts, vs):
-            if t > t0:
-                break
+    def next_signal_change(self, k, t0, v0):
+        '''The first time at or after t0 at which signal k changes from its
+        current value v0, together with its new value.'''
+        sig_arr = self.input_signals_arrays[k]
+        i = np.searchsorted(self.timepoints, float(t0), side='right') - 1
+        if i < 0 and len(sig_arr) > 0 and sig_arr[0] != v0:
+            return self.timepoints[0], sig_arr[0]
 
-            v_current = v
+        change_points = self.change_points[k]
+        j = np.searchsorted(change_points, i + 1)
+        if j < len(change_points):
+            c = change_points[j]
+            return self.timepoints[c], sig_arr[c]
 
-        return v_current
+        return None
 
+    def current_signal_state(self, k, t0, v0):
+        '''The value of signal k at time t0, or v0 before the first sample.'''
+        i = np.searchsorted(self.timepoints, float(t0), side='right') - 1
+        return v0 if i < 0 else self.input_signals_arrays[k][i]
 
     def next_state_update(self, state, t0):
-        next_changes = sorted(
-            filter(
-                (lambda x: x[1] is not None),
-                (
-                    (k, self.next_signal_change(t0, state[k], self.timepoints, sig_arr))
-                    for k, sig_arr
-                    in self.input_signals_arrays.items()
-                )
-            ),
-            key=(lambda x: -x[1][0]),
-        )
+        next_changes = [
+            (k, change)
+            for k in self.input_signals_arrays
+            if (change := self.next_signal_change(k, t0, state[k])) is not None
+        ]
 
-        try:
-            return next_changes[0]
-        except IndexError:
-            return None
+        return max(next_changes, key=(lambda x: x[1][0]), default=None)
     
     def control_step(self, t, state):
         run_duration = RIF("Inf")
 
         output_state = dict(**state)
 
-        for k, sig_arr in self.input_signals_arrays.items():
-            output_state[k] = self.current_signal_state(t.upper(), state[k],
-                self.timepoints, sig_arr)
+        for k in self.input_signals_arrays:
+            output_state[k] = self.current_signal_state(k, t.upper(), state[k])
         
         state_change = self.next_state_update(output_state, t.upper())
         if state_change is not None:
             k, (t_next, v_new) = state_change  # type: ignore
-            return (RIF(t_next) - t, t, output_state)
+            return (RIF(float(t_next)) - t, t, output_state)
         else:
             return (RIF('Inf'), t, output_state)
 
 
+class LiveSignalSwitchedController(BasicController):
+    '''Like SignalArraySwitchedController, but with signals sampled live
+    from a feed (see live_inputs), which is polled at every control step.
+
+    Each signal keeps at most capacity change points. When no future change
+    is known yet, the controller runs for poll_interval before polling
+    again.'''
+
+    def __init__(self, initial_state, feed, keys=None, capacity: int = 4096,
+                 poll_interval=RIF(1)):
+        self.feed = feed
+        self.capacity = capacity
+        self.poll_interval = RIF(poll_interval)
+        self.rings = {
+            k: SampleRing(capacity)
+            for k in (keys if keys is not None else [])
+        }
+        super().__init__(initial_state)
+
+    def append(self, t: float, values: dict):
+        for k, v in values.items():
+            if k not in self.rings:
+                self.rings[k] = SampleRing(self.capacity)
+            self.rings[k].append(float(t), v)
+
+    def poll(self):
+        for t, values in self.feed.poll():
+            self.append(t, values)
+
+    def control_step(self, t, state):
+        self.poll()
+        t0 = float(t.upper())
+
+        output_state = dict(**state)
+        for k, ring in self.rings.items():
+            output_state[k] = ring.value_at(t0, state.get(k))
+
+        next_changes = [
+            change[0] for ring in self.rings.values()
+            if (change := ring.next_change(t0)) is not None
+        ]
+        if next_changes:
+            return (RIF(float(min(next_changes))) - t, t, output_state)
+        else:
+            return (self.poll_interval, t, output_state)
+
+
 class OpenLoopState(Enum):
     INITIALIZED = auto()
     HEATING = auto()
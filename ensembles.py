@@ -0,0 +1,256 @@
+"""Vectorised Monte Carlo ensembles of numerical simulations.
+
+The members of an ensemble are sampled from the interval initial set and
+parameters of a model, and all members in the same discrete mode are
+integrated together as a single stacked NumPy system."""
+
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+import scipy.sparse
+from scipy.integrate import solve_ivp
+from sage.all import RIF, RDF
+import sage.all as sg
+
+from .controllers import TrivialController
+
+
+class PolynomialVectorField:
+    '''A polynomial vector field, evaluated column-wise over a (n_vars, N)
+    array of states.'''
+
+    def __init__(self, polys):
+        self.terms = []
+        for p in polys:
+            monomials = p.dict()
+            self.terms.append((
+                np.array([float(c) for c in monomials.values()]),
+                np.array([list(e) for e in monomials.keys()], dtype=float)
+                    .reshape(len(monomials), -1),
+            ))
+
+    def __call__(self, Y: np.ndarray) -> np.ndarray:
+        dY = np.zeros((len(self.terms), Y.shape[1]))
+        for i, (coeffs, exponents) in enumerate(self.terms):
+            if len(coeffs) > 0:
+                # The value of each monomial for each member
+                monomials = np.prod(Y[None, :, :]**exponents[:, :, None],
+                                    axis=1)
+                dY[i] = coeffs @ monomials
+        return dY
+
+
+class RationalVectorField:
+    '''A vector field whose components are ratios of polynomials, evaluated
+    column-wise over a (n_vars, N) array of states.'''
+
+    def __init__(self, numerators, denominators):
+        self.numerators = PolynomialVectorField(numerators)
+        self.denominators = PolynomialVectorField(denominators)
+
+    def __call__(self, Y: np.ndarray) -> np.ndarray:
+        return self.numerators(Y)/self.denominators(Y)
+
+
+def compile_vector_field(model, sampled: Sequence[str]):
+    '''Compile the ODEs of a ParametricModel into a vector field over its
+    variables followed by the sampled parameters, which have zero
+    derivative. Parameters which only appear as divisors (e.g. the 1/C_A of
+    the incubator models) are replaced by their reciprocals, given by the
+    returned list of flags.
+
+    The vector field is a PolynomialVectorField if the ODEs are polynomial
+    after this, and otherwise a RationalVectorField (e.g. when C_A is a
+    state variable, as in SwitchingFourParameterModelCAGB).'''
+    fixed = {k: RDF(RIF(v).center()) for k, v in model.params.items()
+             if k not in sampled}
+    Ts = [sg.SR(T).subs(**fixed) for T in model.Ts]
+
+    reciprocal = []
+    for p in sampled:
+        if all(T.is_polynomial(sg.var(p)) for T in Ts):
+            reciprocal.append(False)
+        else:
+            Ts = [T.subs({sg.var(p): 1/sg.var(f"{p}_inv")}) for T in Ts]
+            reciprocal.append(True)
+    names = list(model.vs) + [
+        f"{p}_inv" if r else p for p, r in zip(sampled, reciprocal)
+    ]
+    R = sg.PolynomialRing(RDF, names)
+
+    if all(T.is_polynomial(sg.var(v)) for T in Ts for v in names):
+        return (PolynomialVectorField([R(T) for T in Ts]
+                                      + [R(0) for _ in sampled]),
+                reciprocal)
+    try:
+        numerators = [R(T.numerator()) for T in Ts]
+        denominators = [R(T.denominator()) for T in Ts]
+    except (TypeError, ValueError) as e:
+        raise ValueError(
+            f"The ODEs of the model are not rational functions of "
+            f"{', '.join(names)}, so cannot be compiled for an ensemble"
+        ) from e
+    return (RationalVectorField(numerators + [R(0) for _ in sampled],
+                                denominators + [R(1) for _ in sampled]),
+            reciprocal)
+
+
+def sample_box(box: Sequence[Any], n: int, rng) -> np.ndarray:
+    '''n points sampled uniformly from a box of intervals, as an array of
+    shape (len(box), n).'''
+    return np.array([
+        rng.uniform(float(RIF(x).lower()), float(RIF(x).upper()), n)
+        for x in box
+    ]).reshape(len(box), n)
+
+
+class EnsembleResult:
+    '''The states of every member at each of the recorded times, together
+    with the sampled parameters and the discrete state events of each
+    member.'''
+
+    def __init__(self, times, states, params, events):
+        self.times = np.asarray(times)
+        # Shape (n_times, n_members, n_vars)
+        self.states = np.asarray(states)
+        self.params = params
+        self.events = events
+
+    @property
+    def n_members(self) -> int:
+        return self.states.shape[1]
+
+
+class EnsembleSimulator:
+    '''Simulate n_members sampled from the initial set and interval
+    parameters of a model (a ParametricModel or SwitchingParametricModel)
+    under a controller, with separate controller state for each member.
+
+    By default every parameter given as a proper interval is sampled, and
+    param_ranges may give intervals for further parameters.'''
+
+    def __init__(self, model, n_members: int, controller=None,
+                 param_ranges: Optional[Dict[str, Any]] = None, seed=None,
+                 controller_input_map=None, controller_output_map=None,
+                 **solver_kwargs):
+        self.model = model
+        self.n_members = n_members
+        self.controller = (controller if controller is not None
+                           else TrivialController({}))
+        self.param_ranges = {
+            k: v for k, v in model.params.items()
+            if RIF(v).absolute_diameter() > 0
+        }
+        self.param_ranges.update(param_ranges or {})
+        self.rng = np.random.default_rng(seed)
+        self.controller_input_map = (controller_input_map
+                                     if controller_input_map is not None
+                                     else (lambda x: x))
+        self.controller_output_map = (controller_output_map
+                                      if controller_output_map is not None
+                                      else (lambda xin, x: x))
+        self.solver_kwargs = {'method': 'LSODA', **solver_kwargs}
+        self._vector_fields = {}
+
+    @property
+    def switching(self) -> bool:
+        return hasattr(self.model, 'compiled_model')
+
+    @property
+    def x0(self):
+        return self.model.x0 if self.switching else self.model.T0s
+
+    def mode(self, state):
+        return self.model.mode_key(state) if self.switching else None
+
+    def vector_field(self, state):
+        key = self.mode(state)
+        if key not in self._vector_fields:
+            model = (self.model.compiled_model(state) if self.switching
+                     else self.model)
+            self._vector_fields[key] = compile_vector_field(
+                model, list(self.param_ranges))
+        return self._vector_fields[key]
+
+    def integrate(self, f, X, P, t0, t1):
+        '''Integrate the members with states X and parameters P (one column
+        per member) from t0 to t1 as one stacked system.
+
+        The stacked state holds each member's rows contiguously, and the
+        members are independent, so its Jacobian is block diagonal. Implicit
+        solvers are told so, rather than estimating a dense Jacobian over
+        every member.'''
+        n_vars, n = X.shape
+        Y0 = np.vstack([X, P])
+        n_rows = Y0.shape[0]
+
+        def rhs(t, y):
+            return f(y.reshape(n, n_rows).T).T.reshape(-1)
+
+        solver_kwargs = dict(self.solver_kwargs)
+        if solver_kwargs.get('method') == 'LSODA':
+            solver_kwargs.setdefault('lband', n_rows - 1)
+            solver_kwargs.setdefault('uband', n_rows - 1)
+        elif solver_kwargs.get('method') in ('Radau', 'BDF'):
+            solver_kwargs.setdefault('jac_sparsity', scipy.sparse.block_diag(
+                [np.ones((n_rows, n_rows))]*n, format='csc'))
+
+        sln = solve_ivp(rhs, (t0, t1), Y0.T.reshape(-1), **solver_kwargs)
+        if not sln.success:
+            raise RuntimeError(f"Ensemble integration failed: {sln.message}")
+        return sln.y[:, -1].reshape(n, n_rows).T[:n_vars]
+
+    def run(self, time_limit, record_events=True) -> EnsembleResult:
+        '''Run the ensemble up to time_limit, recording the state of every
+        member at each time at which some member's controller acts.'''
+        time_limit = float(RIF(time_limit).upper())
+        n = self.n_members
+        X = sample_box(self.x0, n, self.rng)
+        param_samples = sample_box(list(self.param_ranges.values()), n,
+                                   self.rng)
+
+        controllers = [self.controller.run_iter() for _ in range(n)]
+        states = [next(gen) for gen in controllers]
+        events : List[List[tuple]] = [[(0.0, s)] for s in states]
+        next_event = np.zeros(n)
+        t = 0.0
+        times, history = [t], [X.T.copy()]
+
+        while t < time_limit - 1e-9:
+            due = np.flatnonzero(next_event <= t + 1e-9)
+            for m in due:
+                # Step the controller of each member with an event due
+                xin = [RIF(float(v)) for v in X[:, m]]
+                next(controllers[m])
+                trun, x, states[m] = controllers[m].send(
+                    self.controller_input_map(xin))
+                x = self.controller_output_map(xin, x)
+                X[:, m] = [float(RIF(v).center()) for v in x]
+                next_event[m] = t + float(RIF(trun).lower())
+                if record_events:
+                    events[m].append((t, states[m]))
+            if len(due) > 0:
+                # Allow zero delay events to be processed before time passes
+                continue
+
+            t_next = min(float(next_event.min()), time_limit)
+            groups : Dict[Any, List[int]] = {}
+            for m in range(n):
+                groups.setdefault(self.mode(states[m]), []).append(m)
+            for members in groups.values():
+                f, reciprocal = self.vector_field(states[members[0]])
+                P = np.array([
+                    1/row if r else row
+                    for row, r in zip(param_samples[:, members], reciprocal)
+                ]).reshape(len(reciprocal), len(members))
+                X[:, members] = self.integrate(f, X[:, members], P, t, t_next)
+
+            t = t_next
+            times.append(t)
+            history.append(X.T.copy())
+
+        return EnsembleResult(
+            times, history,
+            dict(zip(self.param_ranges, param_samples)),
+            events,
+        )
@@ -0,0 +1,363 @@
+"""A binary archive format for verified hybrid traces.
+
+An archive is a single file holding, for each continuous segment, interval
+boxes enclosing the state over consecutive time steps of a chosen
+resolution, optionally the pickled segment itself (e.g. an lbuc.Reach with
+its Taylor models), and the discrete states between the segments as JSON. The
+segment and event indices are stored at the end of the file, followed by a
+fixed size trailer locating them, so that archives can be written while a
+run is streamed. Archives are read through a memory map, and a segment is
+only decoded when it is queried. Pickled segments are only loaded from
+archives opened with allow_pickle, as unpickling can run arbitrary code.
+
+Layout:
+
+    MAGIC
+    for each segment: boxes (float64, shape (n_boxes, 1 + n_vars, 2)),
+                      followed by the optional pickled segment
+    for each discrete state: the state dict as JSON
+    segment index (SEGMENT_DTYPE), event index (EVENT_DTYPE), JSON header
+    header offset (uint64), header length (uint64), MAGIC
+
+The first column of each box holds its local time interval, and the last box
+of each segment is the state at its end."""
+
+import bisect
+import enum
+import json
+import mmap
+import pickle
+import struct
+from typing import Any, Dict, IO, Iterable, List, Optional
+
+import numpy as np
+from sage.all import RIF
+
+from .traces import (BoxSegment, ReachSegment, VerifiedHybridTrace,
+                     is_numerical_segment, segment_boxes)
+
+
+MAGIC = b'VTFLOW02'
+TRAILER = struct.Struct('<QQ8s')
+
+SEGMENT_DTYPE = np.dtype([
+    ('start_lo', '<f8'), ('start_hi', '<f8'),
+    ('time_lo', '<f8'), ('time_hi', '<f8'),
+    ('box_offset', '<i8'), ('n_boxes', '<i8'),
+    ('reach_offset', '<i8'), ('reach_length', '<i8'),
+])
+
+EVENT_DTYPE = np.dtype([
+    ('t_lo', '<f8'), ('t_hi', '<f8'),
+    # The number of segments before the event
+    ('segment', '<i8'),
+    ('offset', '<i8'), ('length', '<i8'),
+])
+
+
+def encode_state(state: Dict[str, Any]) -> bytes:
+    '''Encode a discrete state as JSON. Enums are stored by name, together
+    with the qualified name of their type.'''
+    def encode(v):
+        if isinstance(v, enum.Enum):
+            return {'enum': f"{type(v).__module__}.{type(v).__qualname__}",
+                    'name': v.name}
+        if isinstance(v, np.generic):
+            return v.item()
+        if v is None or isinstance(v, (bool, int, float, str)):
+            return v
+        raise TypeError(f"Cannot archive the discrete state value {v!r}")
+    return json.dumps({k: encode(v) for k, v in state.items()}).encode()
+
+
+def decode_state(blob: bytes, enum_types: Optional[Dict[str, type]] = None
+                 ) -> Dict[str, Any]:
+    '''Decode a discrete state encoded by encode_state. Enums are decoded to
+    their names unless their types are given in enum_types.'''
+    enum_types = enum_types or {}
+    state = json.loads(blob)
+    for k, v in state.items():
+        if isinstance(v, dict) and 'enum' in v:
+            state[k] = (enum_types[k][v['name']] if k in enum_types
+                        else v['name'])
+    return state
+
+
+class FlowpipeWriter:
+    '''Writes the values of a verified hybrid run to an archive at path as
+    they are produced. The segments themselves are only pickled if
+    store_segments is set.'''
+
+    def __init__(self, path: str, resolution: Optional[float] = None,
+                 store_segments: bool = False, start_time=RIF(0)):
+        self.path = path
+        self.resolution = resolution
+        self.store_segments = store_segments
+        self.vs : Optional[List[str]] = None
+        self.t = RIF(start_time)
+        self.start_time = RIF(start_time)
+        self._segments : List[tuple] = []
+        self._events : List[tuple] = []
+        self._discrete : List[bytes] = []
+        self.file : Optional[IO[bytes]] = open(path, 'wb')
+        self.file.write(MAGIC)
+
+    def _align(self):
+        # Keep arrays 8 byte aligned within the file
+        self.file.write(b'\0'*(-self.file.tell() % 8))
+
+    def write(self, v):
+        if isinstance(v, dict) and not is_numerical_segment(v):
+            # Discrete states are written after the segments, so that the
+            # boxes of consecutive segments are close together
+            self._events.append((float(self.t.lower()), float(self.t.upper()),
+                                 len(self._segments)))
+            self._discrete.append(encode_state(v))
+            return v
+
+        if self.vs is None:
+            self.vs = list(v.vs)
+        boxes = segment_boxes(v, self.resolution)
+        self._align()
+        box_offset = self.file.tell()
+        self.file.write(boxes.tobytes())
+        reach_offset = reach_length = 0
+        if self.store_segments:
+            blob = pickle.dumps(v)
+            reach_offset = self.file.tell()
+            reach_length = len(blob)
+            self.file.write(blob)
+
+        time = RIF(v.time)
+        self._segments.append((
+            float(self.t.lower()), float(self.t.upper()),
+            float(time.lower()), float(time.upper()),
+            box_offset, len(boxes), reach_offset, reach_length,
+        ))
+        self.t += time
+        return v
+
+    def write_all(self, values: Iterable[Any]):
+        for v in values:
+            self.write(v)
+
+    def close(self):
+        if self.file is None:
+            return
+        events = np.empty(len(self._events), dtype=EVENT_DTYPE)
+        for i, ((t_lo, t_hi, k), blob) in enumerate(
+                zip(self._events, self._discrete)):
+            events[i] = (t_lo, t_hi, k, self.file.tell(), len(blob))
+            self.file.write(blob)
+
+        self._align()
+        segment_index_offset = self.file.tell()
+        self.file.write(np.array(self._segments, dtype=SEGMENT_DTYPE).tobytes())
+        event_index_offset = self.file.tell()
+        self.file.write(events.tobytes())
+
+        header = json.dumps({
+            'vs': self.vs or [],
+            'resolution': self.resolution,
+            'domain': [float(self.start_time.lower()), float(self.t.upper())],
+            'n_segments': len(self._segments),
+            'n_events': len(self._events),
+            'segment_index_offset': segment_index_offset,
+            'event_index_offset': event_index_offset,
+        }).encode()
+        header_offset = self.file.tell()
+        self.file.write(header)
+        self.file.write(TRAILER.pack(header_offset, len(header), MAGIC))
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_archive(path: str, trace: Iterable[Any], **kwargs):
+    '''Archive a verified (hybrid or continuous) trace or the values of a
+    verified run, consuming a streamed trace as it goes.'''
+    if 'start_time' not in kwargs and hasattr(trace, 'retained_start'):
+        kwargs['start_time'] = trace.retained_start
+    with FlowpipeWriter(path, **kwargs) as writer:
+        writer.write_all(trace)
+
+
+class ArchivedSegment(BoxSegment):
+    '''A segment of an archive, whose boxes are only read from the archive
+    when it is first queried.'''
+
+    def __init__(self, archive: 'FlowpipeArchive', k: int):
+        entry = archive.segments[k]
+        super().__init__(archive.vs, RIF(entry['time_lo'], entry['time_hi']),
+                         None)
+        self.archive = archive
+        self.k = k
+
+    @property
+    def boxes(self) -> np.ndarray:
+        '''The archived boxes, as a view of the memory mapped file.'''
+        if self._boxes is None:
+            entry = self.archive.segments[self.k]
+            self._boxes = np.frombuffer(
+                self.archive.buffer, dtype='<f8',
+                count=int(entry['n_boxes'])*(1 + len(self.vs))*2,
+                offset=int(entry['box_offset']),
+            ).reshape(-1, 1 + len(self.vs), 2)
+        return self._boxes
+
+    def segment(self) -> Optional[ReachSegment]:
+        '''The original segment, if it was stored. This unpickles it, so is
+        only allowed if the archive was opened with allow_pickle.'''
+        entry = self.archive.segments[self.k]
+        if entry['reach_length'] == 0:
+            return None
+        if not self.archive.allow_pickle:
+            raise ValueError("Stored segments cannot be loaded when "
+                             "allow_pickle=False")
+        offset = int(entry['reach_offset'])
+        return pickle.loads(
+            self.archive.buffer[offset:offset + int(entry['reach_length'])])
+
+
+class FlowpipeArchive:
+    '''A memory mapped flowpipe archive. Opening an archive only reads its
+    indices, and segments are decoded when they are queried.
+
+    The pickled segments stored in the archive can only be loaded if
+    allow_pickle is set, which should only be done for trusted archives.
+    Enum valued discrete states are decoded to their names unless their
+    types are given in enum_types.'''
+
+    def __init__(self, path: str, allow_pickle: bool = False,
+                 enum_types: Optional[Dict[str, type]] = None):
+        self.path = path
+        self.allow_pickle = allow_pickle
+        self.enum_types = enum_types
+        self.file = open(path, 'rb')
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        header_offset, header_length, magic = TRAILER.unpack_from(
+            self.buffer, len(self.buffer) - TRAILER.size)
+        if self.buffer[:len(MAGIC)] != MAGIC or magic != MAGIC:
+            raise ValueError(f"{path} is not a flowpipe archive")
+
+        self.header = json.loads(
+            self.buffer[header_offset:header_offset + header_length])
+        self.vs : List[str] = self.header['vs']
+        self.segments = np.frombuffer(
+            self.buffer, dtype=SEGMENT_DTYPE,
+            count=self.header['n_segments'],
+            offset=self.header['segment_index_offset'])
+        self.events = np.frombuffer(
+            self.buffer, dtype=EVENT_DTYPE, count=self.header['n_events'],
+            offset=self.header['event_index_offset'])
+        # The ends of the segments, rounded outwards
+        self.segment_ends = np.nextafter(
+            self.segments['start_hi'] + self.segments['time_hi'], np.inf)
+        self._segment_cache : Dict[int, ArchivedSegment] = {}
+
+    @property
+    def domain(self) -> RIF:
+        return RIF(*self.header['domain'])
+
+    def __len__(self) -> int:
+        return len(self.segments)
+
+    def segment(self, k: int) -> ArchivedSegment:
+        if k not in self._segment_cache:
+            self._segment_cache[k] = ArchivedSegment(self, k)
+        return self._segment_cache[k]
+
+    def segment_start(self, k: int) -> RIF:
+        return RIF(self.segments[k]['start_lo'], self.segments[k]['start_hi'])
+
+    def discrete_state(self, i: int) -> Dict[str, Any]:
+        event = self.events[i]
+        offset = int(event['offset'])
+        return decode_state(self.buffer[offset:offset + int(event['length'])],
+                            self.enum_types)
+
+    def segments_overlapping(self, t) -> range:
+        '''The indices of the segments which may overlap the (absolute)
+        time interval t.'''
+        t = RIF(t)
+        # Segment ends are non-decreasing, as are segment starts
+        first = np.searchsorted(self.segment_ends, float(t.lower()),
+                                side='left')
+        last = np.searchsorted(self.segments['start_lo'], float(t.upper()),
+                               side='right')
+        return range(int(first), int(last))
+
+    def __call__(self, t) -> Optional[List[RIF]]:
+        '''An enclosure of the state at the absolute time t.'''
+        t = RIF(t)
+        enclosure = None
+        for k in self.segments_overlapping(t):
+            r = self.segment(k)
+            tt = t - self.segment_start(k)
+            if tt.upper() < 0 or tt.lower() > r.time.upper():
+                continue
+            x = r(RIF(max(tt.lower(), 0), min(tt.upper(), r.time.upper())))
+            enclosure = (x if enclosure is None
+                         else [a.union(b) for a, b in zip(enclosure, x)])
+        return enclosure
+
+    def state_at(self, t) -> Optional[Dict[str, Any]]:
+        '''The discrete state entered last at or before the time t.'''
+        i = bisect.bisect_right(self.events['t_lo'], float(RIF(t).upper())) - 1
+        return None if i < 0 else self.discrete_state(i)
+
+    def values(self, window=None):
+        '''The discrete states and segments of the archive, in order,
+        restricted to those overlapping the time window if given.'''
+        segments = (range(len(self)) if window is None
+                    else self.segments_overlapping(window))
+        if len(segments) == 0:
+            return
+        event_segments = self.events['segment']
+        first_event = (0 if segments.start == 0
+                       else max(int(np.searchsorted(event_segments,
+                                                    segments.start,
+                                                    side='right')) - 1, 0))
+        i = first_event
+        for k in segments:
+            while i < len(self.events) and event_segments[i] <= k:
+                yield self.discrete_state(i)
+                i += 1
+            yield self.segment(k)
+        if segments.stop == len(self):
+            for j in range(i, len(self.events)):
+                yield self.discrete_state(j)
+
+    def trace(self, window=None) -> VerifiedHybridTrace:
+        '''The archive (or the part overlapping the time window) as a
+        VerifiedHybridTrace of ArchivedSegments.'''
+        segments = (range(len(self)) if window is None
+                    else self.segments_overlapping(window))
+        if len(segments) == 0:
+            domain = self.domain if window is None else RIF(window)
+        else:
+            domain = RIF(self.segments[segments.start]['start_lo'],
+                         self.segment_ends[segments.stop - 1])
+        return VerifiedHybridTrace(domain, self.values(window))
+
+    def close(self):
+        self.segments = self.events = self.segment_ends = None
+        self._segment_cache.clear()
+        try:
+            self.buffer.close()
+        except BufferError:
+            # Boxes are still referenced elsewhere, so leave the map to be
+            # released along with them
+            pass
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -84,6 +84,9 @@ class SwitchingFourParameterModel(SwitchingParametricModel):
         default_params.update(params_RIF)
         super().__init__(x0, **default_params)
 
+    def mode_key(self, state):
+        return bool(state['heater_on'])
+
     def model_fn(self, x, state):
         return IntervalParametricModel(
             "t,T_H,T_A",
@@ -118,6 +121,9 @@ class SwitchingFourParameterModelCAGB(SwitchingParametricModel):
         default_params.update(params_RIF)
         super().__init__(x0, **default_params)
 
+    def mode_key(self, state):
+        return bool(state['heater_on'])
+
     def model_fn(self, x, state):
         # print(f"regenerating model with x={[xi.str(style='brackets') for xi in x]}")
         return IntervalParametricModel(
@@ -3,18 +3,114 @@ from lbuc import *
 # We are going to redefine atomic propositions
 del globals()['Atomic']
 
-from .traces import HybridTrace, VerifiedContinuousTrace
+from sage.all import RIF
+import sage.all as sg
+
+from .traces import (HybridTrace, ReachSegment, VerifiedContinuousTrace,
+                     exact_key)
+
+
+def merge_signals(sigs, domain) -> Signal:
+    '''The union of a sequence of signals over the given domain. Signals are
+    merged pairwise in a balanced tree, so each value takes part in
+    O(log n) unions rather than the O(n) of a left fold.'''
+    sigs = list(sigs)
+    while len(sigs) > 1:
+        merged = [a.union(b) for a, b in zip(sigs[::2], sigs[1::2])]
+        if len(sigs) % 2 == 1:
+            merged.append(sigs[-1])
+        sigs = merged
+
+    return reduce(Signal.union, sigs, Signal(domain, []))
+
+
+class SignalCache:
+    '''While active (as a context manager), the signals of atomic
+    propositions are cached by proposition and segment, and by proposition
+    and trace, so that monitoring several formulas sharing propositions
+    over the same trace computes each proposition's signals only once.
+
+    Propositions are identified by their exact terms (see Atomic.key), as
+    their string forms round interval coefficients. Cached segments and
+    traces are kept alive by the cache, so that their ids are not reused.'''
+
+    def __init__(self):
+        self.segments = {}
+        self.traces = {}
+        self.hits = 0
+        self.misses = 0
+        self._previous = None
+
+    def lookup(self, table, key, compute):
+        if key in table:
+            self.hits += 1
+            return table[key][1]
+        self.misses += 1
+        obj, v = compute()
+        table[key] = (obj, v)
+        return v
+
+    def __enter__(self):
+        global _signal_cache
+        self._previous = _signal_cache
+        _signal_cache = self
+        return self
+
+    def __exit__(self, *exc):
+        global _signal_cache
+        _signal_cache = self._previous
+
+
+# The active SignalCache, if any
+_signal_cache = None
+
+
+def monitor_batch(formulas, trace):
+    '''The signal of each formula (a sequence, or a dict by name) over the
+    trace, sharing the signals of common atomic propositions between the
+    formulas.'''
+    with SignalCache():
+        if isinstance(formulas, dict):
+            return {name: f.signal(trace) for name, f in formulas.items()}
+        return [f.signal(trace) for f in formulas]
 
 
 class Atomic(lbuc.Atomic):
     '''Extend Atomic in order to allow monitoring over continuous and hybrid
-    traces.'''
+    traces.
+
+    Segments other than lbuc Reach objects (e.g. CoalescedSegment or
+    LinearReach) are monitored over the box enclosing the whole segment.'''
+
+    def __init__(self, p, *args, **kwargs):
+        super().__init__(p, *args, **kwargs)
+        self._term = p
+        self._args = (args, kwargs)
+        self._box_fns = {}
+
+    @property
+    def key(self) -> tuple:
+        '''A hashable key identifying the proposition exactly, from the
+        arguments it was constructed with.'''
+        args, kwargs = self._args
+        return (type(self).__name__, exact_key(self._term),
+                tuple(exact_key(a) for a in args),
+                tuple(sorted((k, exact_key(v)) for k, v in kwargs.items())))
 
     def signal(self, trace, *args, **kwargs):
         # We just have a single reach sequence
         if isinstance(trace, Reach):
             return super().signal(trace, *args, **kwargs)
         
+        if _signal_cache is not None:
+            return _signal_cache.lookup(
+                _signal_cache.traces,
+                (self.key, id(trace), repr(args),
+                 repr(sorted(kwargs.items()))),
+                lambda: (trace, self._trace_signal(trace, *args, **kwargs)))
+        return self._trace_signal(trace, *args, **kwargs)
+
+    def _trace_signal(self, trace, *args, **kwargs):
         # We have a full hybrid trace and want to monitor the continuous part
         if isinstance(trace, HybridTrace):
             trace = trace.continuous_part
@@ -23,11 +119,112 @@ class Atomic(lbuc.Atomic):
         assert isinstance(trace, VerifiedContinuousTrace)
 
         # Generate the overall signal
-        sigs = []
-        start_time = trace.domain.edges()[0]
-        for r in trace:
-            sig = super().signal(r, symbolic_composition=True)
-            sigs.append(sig.G(-start_time.edges()[0]))
+        sigs = self.segment_signals(trace, trace.domain.edges()[0])
+
+        return merge_signals(sigs, trace.domain)
+
+    def segment_signals(self, reaches, start_time):
+        '''Yield the signal of each of a sequence of reach segments,
+        shifted to the absolute time at which the segment starts.'''
+        for r in reaches:
+            sig = self.segment_signal(r)
+            yield sig.G(-start_time.edges()[0])
             start_time += sig.domain.edges()[1]
 
-        return reduce(Signal.union, sigs, Signal(trace.domain, []))
\ No newline at end of file
+    def segment_signal(self, r):
+        '''The signal of a single reach segment, relative to its start.'''
+        if _signal_cache is not None:
+            return _signal_cache.lookup(
+                _signal_cache.segments, (self.key, id(r)),
+                lambda: (r, self._segment_signal(r)))
+        return self._segment_signal(r)
+
+    def _segment_signal(self, r):
+        if isinstance(r, Reach):
+            return super().signal(r, symbolic_composition=True)
+        if isinstance(r, ReachSegment):
+            return self.box_signal(r)
+        raise TypeError(f"Cannot monitor a segment of type {type(r).__name__}")
+
+    def box_signal(self, r: ReachSegment) -> Signal:
+        '''The signal of a segment over the box enclosing the whole segment,
+        which is only decided if the term has the same sign over the box.'''
+        vs = tuple(r.vs)
+        if vs not in self._box_fns:
+            self._box_fns[vs] = sg.fast_callable(self._term, vars=list(vs),
+                                                 domain=RIF)
+        domain = RIF(0, RIF(r.time).upper())
+        value = self._box_fns[vs](*r(domain))
+        if value.lower() > 0:
+            return Signal(domain, [(domain, True)])
+        if value.upper() <= 0:
+            return Signal(domain, [(domain, False)])
+        return Signal(domain, [])
+
+
+class OnlineMonitor:
+    '''Monitor an atomic proposition over a time window while a hybrid
+    simulation is running, stopping the simulation as soon as the verdict
+    is decided.
+
+    In 'always' mode the proposition must hold throughout the window and in
+    'eventually' mode it must hold at some point in the window.'''
+
+    def __init__(self, atomic: Atomic, window, mode='always'):
+        assert mode in ('always', 'eventually')
+        self.atomic = atomic
+        self.window = RIF(window)
+        self.mode = mode
+        self.sigs = []
+        self.verdict = None
+        self._start_time = RIF(0)
+        # Time up to which the window is covered by the signal value which
+        # decides the opposite verdict
+        self._covered_until = self.window.lower()
+
+    @property
+    def signal(self) -> Signal:
+        '''The signal of the part of the run monitored so far.'''
+        domain = RIF(self.window.lower(), self._start_time.upper())
+        return merge_signals(self.sigs, domain)
+
+    def update(self, reach: ReachSegment):
+        '''Add the next reach segment of the run, returning the verdict if
+        it is now decided.'''
+        if self.verdict is not None:
+            return self.verdict
+
+        sig, = self.atomic.segment_signals([reach], self._start_time)
+        self.sigs.append(sig)
+        self._start_time += RIF(reach.time)
+
+        # The value which decides the verdict at a single time point
+        decisive = self.mode == 'eventually'
+        for d, b in sig.values:
+            if (d.upper() < self.window.lower()
+                    or d.lower() > self.window.upper()):
+                continue
+            if b == decisive:
+                self.verdict = decisive
+                return self.verdict
+            if d.lower() <= self._covered_until:
+                self._covered_until = max(self._covered_until, d.upper())
+        if self._covered_until >= self.window.upper():
+            self.verdict = not decisive
+
+        return self.verdict
+
+    def run(self, simulator, **run_kwargs):
+        '''Monitor a run of a hybrid simulator, returning the verdict, or
+        None if it is still undecided when the window has been simulated.'''
+        run = simulator.run_iter(time_limit=RIF(self.window.upper()),
+                                 **run_kwargs)
+        try:
+            for v in run:
+                if (isinstance(v, ReachSegment)
+                        and self.update(v) is not None):
+                    break
+        finally:
+            run.close()
+
+        return self.verdict
\ No newline at end of file
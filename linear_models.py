@@ -0,0 +1,187 @@
+"""Exact propagation of affine models through (interval) matrix exponentials.
+
+In each mode the incubator models are affine ODEs dx/dt = Ax + b, so a step
+of any duration is a single matrix-vector product with exp([[A, b], [0, 0]]t)
+applied to (x, 1), and the exponential can be cached per step duration."""
+
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import numpy as np
+import scipy.linalg
+from scipy.integrate import DenseOutput, OdeSolution
+from scipy.optimize import OptimizeResult
+from sage.all import RIF, RR
+import sage.all as sg
+
+from .traces import ReachSegment
+
+
+def interval_expm(M, order: int = 12):
+    '''An interval matrix enclosing exp(N) for every real matrix N in the
+    interval matrix M, using a Taylor series with a bound on the remainder
+    after scaling and squaring.'''
+    n = M.nrows()
+    norm = max(
+        sum((RIF(abs(M[i, j]).upper()) for j in range(n)), RIF(0)).upper()
+        for i in range(n)
+    )
+    s = 0
+    while norm/2**s > 0.5:
+        s += 1
+    M = M/2**s
+    rho = RIF(norm)/2**s
+
+    term = S = sg.identity_matrix(RIF, n)
+    for k in range(1, order + 1):
+        term = term*M/k
+        S = S + term
+    # The remainder of the series is bounded entrywise by its norm
+    r = (rho**(order + 1)/sg.factorial(order + 1)/(1 - rho/(order + 2))).upper()
+    S = S + sg.matrix(RIF, n, n, [RIF(-r, r)]*(n*n))
+
+    for _ in range(s):
+        S = S*S
+    return S
+
+
+def interval_key(t) -> Tuple[float, float]:
+    t = RIF(t)
+    return float(t.lower()), float(t.upper())
+
+
+class AffineSystem:
+    '''The affine vector field dx/dt = Ax + b of a model, represented by the
+    augmented matrix [[A, b], [0, 0]] acting on (x, 1).'''
+
+    # The number of interval exponentials kept in the LRU cache
+    max_cached = 64
+    # Above this condition number of its eigenvectors, A_aug is treated as
+    # defective and exponentials are computed one time at a time
+    max_eigenvector_condition = 1e6
+
+    def __init__(self, vs: List[str], A_aug):
+        self.vs = vs
+        self.A_aug = sg.matrix(RIF, A_aug)
+        self.A_aug_float = np.array(
+            [[float(RIF(a).center()) for a in row] for row in A_aug])
+        self._expm : OrderedDict = OrderedDict()
+        self._eig : Optional[tuple] = None
+
+    @classmethod
+    def from_model(cls, model) -> Optional['AffineSystem']:
+        '''The affine system of a ParametricModel, or None if its vector
+        field is not affine.'''
+        if model.nonpoly or any(T.degree() > 1 for T in model.y):
+            return None
+        gens = model.R.gens()
+        n = len(gens)
+        A_aug = [
+            [T.monomial_coefficient(g) for g in gens] + [T.constant_coefficient()]
+            for T in model.y
+        ] + [[0]*(n + 1)]
+        return cls(list(model.vs), A_aug)
+
+    def _cached_expm(self, key, compute, cache: bool):
+        try:
+            E = self._expm[key]
+        except KeyError:
+            E = compute()
+            if cache:
+                self._expm[key] = E
+                if len(self._expm) > self.max_cached:
+                    self._expm.popitem(last=False)
+        else:
+            self._expm.move_to_end(key)
+        return E
+
+    def expm(self, t, cache: bool = False):
+        '''An enclosure of exp(A_aug*t) for all t in the interval t. An
+        interval [a, b] is split as exp(A_aug*a)*exp(A_aug*[0, w]), where w
+        is an upper bound on b - a, to limit the overapproximation.
+
+        The factors are kept in a LRU cache if cache is set, which should
+        only be done for times shared between steps (e.g. step durations).'''
+        a, b = interval_key(t)
+        if a == b:
+            return self._cached_expm(
+                ('point', a), lambda: interval_expm(self.A_aug*RIF(a)), cache)
+        w = (RIF(b) - RIF(a)).upper()
+        tile = self._cached_expm(
+            ('tile', float(w)),
+            lambda: interval_expm(self.A_aug*RIF(0, w)), cache)
+        return self.expm(RIF(a), cache)*tile
+
+    def _eigendecomposition(self) -> tuple:
+        '''The eigenvalues, eigenvectors and inverse eigenvectors of A_aug,
+        or () if it is (nearly) defective.'''
+        if self._eig is None:
+            lam, V = np.linalg.eig(self.A_aug_float)
+            self._eig = (
+                (lam, V, np.linalg.inv(V))
+                if np.linalg.cond(V) <= self.max_eigenvector_condition
+                else ()
+            )
+        return self._eig
+
+    def propagate_float(self, x0_aug: np.ndarray, ts) -> np.ndarray:
+        '''exp(A_aug*t) @ x0_aug for each of the times ts, as an array of
+        shape (n + 1, len(ts)), computed for all times at once from an
+        eigendecomposition of A_aug unless it is defective.'''
+        ts = np.asarray(ts, dtype=float)
+        eig = self._eigendecomposition()
+        if not eig:
+            return np.stack([scipy.linalg.expm(self.A_aug_float*t) @ x0_aug
+                             for t in ts], axis=1)
+        lam, V, V_inv = eig
+        c = V_inv @ x0_aug
+        return (V @ (np.exp(np.outer(lam, ts))*c[:, None])).real
+
+    def reach(self, x0, time) -> 'LinearReach':
+        return LinearReach(self, x0, RIF(time))
+
+    def solve(self, x0, time) -> OptimizeResult:
+        '''A numerical solution with the same interface as solve_ivp.'''
+        time = float(time)
+        x0_aug = np.append(np.asarray(x0, dtype=float), 1.0)
+        sol = OdeSolution([0.0, time], [LinearDenseOutput(self, x0_aug, time)])
+        return OptimizeResult(
+            t=np.array([0.0, time]),
+            y=np.stack([x0_aug[:-1], sol(time)], axis=1),
+            sol=sol,
+            success=True,
+            status=0,
+            message="Propagated with the matrix exponential.",
+        )
+
+
+class LinearReach(ReachSegment):
+    '''A verified segment of an affine system from the box x0.'''
+
+    def __init__(self, system: AffineSystem, x0, time: RIF):
+        self.system = system
+        self.vs = system.vs
+        self.x0_aug = sg.vector(RIF, list(x0) + [1])
+        self.time = time
+
+    def __call__(self, t) -> List[RIF]:
+        t = RIF(t)
+        # Only times within the segment are meaningful
+        lower = min(max(t.lower(), RR(0)), self.time.upper())
+        tt = RIF(lower, max(min(t.upper(), self.time.upper()), lower))
+        # Only the exponentials over the whole segment and at its end are
+        # shared with other steps of the same duration
+        cache = (tt.upper() == self.time.upper()
+                 and tt.lower() in (0, self.time.lower()))
+        return list(self.system.expm(tt, cache)*self.x0_aug)[:-1]
+
+
+class LinearDenseOutput(DenseOutput):
+    def __init__(self, system: AffineSystem, x0_aug: np.ndarray, time: float):
+        super().__init__(0.0, time)
+        self.system = system
+        self.x0_aug = x0_aug
+
+    def _call_impl(self, t):
+        y = self.system.propagate_float(self.x0_aug, np.atleast_1d(t))[:-1]
+        return y[:, 0] if np.ndim(t) == 0 else y
@@ -0,0 +1,209 @@
+"""Live timestamped input samples for controllers driven by a running system.
+
+Samples arrive from a feed, whose poll method returns the samples received
+since it was last polled as (time, {signal: value}) pairs, and are kept in a
+bounded SampleRing per signal."""
+
+import codecs
+import json
+import queue
+import socket
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+Sample = Tuple[float, Dict[str, Any]]
+
+
+class SampleRing:
+    '''An append-only ring buffer of the points at which a piecewise constant
+    signal changes value, keeping at most capacity change points.
+
+    The buffer is mirrored, i.e. each entry is written at two positions, so
+    that the retained change points are always a contiguous slice which can
+    be binary searched without copying.'''
+
+    def __init__(self, capacity: int, dtype=object):
+        assert capacity > 0
+        self.capacity = capacity
+        self._times = np.empty(2*capacity)
+        self._values = np.empty(2*capacity, dtype=dtype)
+        self.start = 0
+        self.size = 0
+        # The value of the most recently evicted change point, which holds
+        # up to the first retained one
+        self.evicted_value : Any = None
+        self.n_evicted = 0
+        # The time of the latest sample, even if it did not change the value
+        self.latest_time = -np.inf
+
+    @property
+    def times(self) -> np.ndarray:
+        return self._times[self.start:self.start + self.size]
+
+    @property
+    def values(self) -> np.ndarray:
+        return self._values[self.start:self.start + self.size]
+
+    @property
+    def last_value(self):
+        return self._values[self.start + self.size - 1] if self.size else None
+
+    def append(self, t: float, v):
+        '''Record that the signal had value v at time t, which must not be
+        before the latest sample.'''
+        if t < self.latest_time:
+            raise ValueError(f"Sample at {t} is older than the latest sample "
+                             f"at {self.latest_time}")
+        self.latest_time = t
+        if self.size and self.last_value == v:
+            return
+
+        if self.size == self.capacity:
+            self.evicted_value = self._values[self.start]
+            self.n_evicted += 1
+            self.start = (self.start + 1) % self.capacity
+            self.size -= 1
+        i = (self.start + self.size) % self.capacity
+        self._times[i] = self._times[i + self.capacity] = t
+        self._values[i] = self._values[i + self.capacity] = v
+        self.size += 1
+
+    def value_at(self, t: float, default=None):
+        '''The value of the signal at time t, or default if it is not known.'''
+        i = np.searchsorted(self.times, t, side='right') - 1
+        if i >= 0:
+            return self.values[i]
+        return self.evicted_value if self.n_evicted else default
+
+    def next_change(self, t: float) -> Optional[Tuple[float, Any]]:
+        '''The first known change strictly after time t.'''
+        i = np.searchsorted(self.times, t, side='right')
+        if i < self.size:
+            return self.times[i], self.values[i]
+        return None
+
+
+class QueueFeed:
+    '''Samples put on an in-process queue.Queue by another thread.'''
+
+    def __init__(self, q: Optional[queue.Queue] = None):
+        self.queue = q if q is not None else queue.Queue()
+
+    def put(self, t: float, values: Dict[str, Any]):
+        self.queue.put((t, values))
+
+    def poll(self) -> List[Sample]:
+        samples = []
+        while True:
+            try:
+                samples.append(self.queue.get_nowait())
+            except queue.Empty:
+                return samples
+
+
+class ReplayFeed:
+    '''Replays recorded samples as though they were arriving live, at speed
+    times real time from the first poll. With speed=None every sample is
+    available immediately.'''
+
+    def __init__(self, timepoints, input_signals_arrays: Dict[str, Any],
+                 speed: Optional[float] = 1.0):
+        self.timepoints = np.asarray(timepoints)
+        self.input_signals_arrays = {
+            k: np.asarray(sig_arr)
+            for k, sig_arr in input_signals_arrays.items()
+        }
+        self.speed = speed
+        self.position = 0
+        self._started : Optional[float] = None
+
+    def poll(self) -> List[Sample]:
+        if self.speed is None:
+            end = len(self.timepoints)
+        else:
+            if self._started is None:
+                self._started = time.monotonic()
+            elapsed = (time.monotonic() - self._started)*self.speed
+            end = np.searchsorted(self.timepoints,
+                                  self.timepoints[0] + elapsed
+                                  if len(self.timepoints) else 0.0,
+                                  side='right')
+        samples = [
+            (float(self.timepoints[i]),
+             {k: sig_arr[i] for k, sig_arr in self.input_signals_arrays.items()})
+            for i in range(self.position, end)
+        ]
+        self.position = max(self.position, end)
+        return samples
+
+
+def parse_json_sample(line: str) -> Sample:
+    '''Parse a sample written as a JSON object with a time field "t", e.g.
+    {"t": 12.0, "heater_on": true}.'''
+    sample = json.loads(line)
+    return float(sample.pop('t')), sample
+
+
+class _LineFeed:
+    '''Samples received one per line, keeping incomplete lines until the
+    rest of the line arrives.'''
+
+    def __init__(self, parse=parse_json_sample):
+        self.parse = parse
+        self._partial = ''
+
+    def _read(self) -> str:
+        raise NotImplementedError()
+
+    def poll(self) -> List[Sample]:
+        lines = (self._partial + self._read()).split('\n')
+        self._partial = lines.pop()
+        return [self.parse(line) for line in lines if line.strip()]
+
+
+class FileTailFeed(_LineFeed):
+    '''Samples appended to a text file, starting from its current end
+    unless from_start is set.'''
+
+    def __init__(self, path: str, parse=parse_json_sample,
+                 from_start: bool = False):
+        super().__init__(parse)
+        self.file = open(path, 'r')
+        if not from_start:
+            self.file.seek(0, 2)
+
+    def _read(self) -> str:
+        return self.file.read()
+
+    def close(self):
+        self.file.close()
+
+
+class SocketFeed(_LineFeed):
+    '''Samples received on a connected stream socket.'''
+
+    def __init__(self, sock: socket.socket, parse=parse_json_sample,
+                 encoding: str = 'utf-8'):
+        super().__init__(parse)
+        self.socket = sock
+        self.socket.setblocking(False)
+        # Characters may be split between chunks
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+
+    def _read(self) -> str:
+        chunks = []
+        while True:
+            try:
+                chunk = self.socket.recv(65536)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return self.decoder.decode(b''.join(chunks))
+
+    def close(self):
+        self.socket.close()
@@ -1,3 +1,7 @@
+from collections import OrderedDict
+from typing import Optional
+import copy
+
 from .base import *
 from sage.all import RR, QQ
 import sage.all as sg
@@ -6,12 +10,17 @@ from sage.symbolic.function_factory import function_factory
 
 import lbuc
 
+from .ensembles import EnsembleSimulator
+from .linear_models import AffineSystem
 from .simulation_framework import Model
 from .traces import VerifiedContinuousTrace, NumericalContinuousTrace
 
 
 class ParametricModel(lbuc.System, Model):
     BaseField = None
+    # Propagate affine vector fields with matrix exponentials rather than
+    # integrating them
+    linear_propagation = False
     
     def __init__(self, vs : str, T0s : list, Ts : list, params : dict, nonpoly=False, vars=None):
         if nonpoly:
@@ -24,9 +33,27 @@ class ParametricModel(lbuc.System, Model):
         self.Ts = Ts
         self.T0s = T0s
         self.params = params
+        # Data derived from the vector field, shared with copies of the model
+        # for other initial conditions
+        self._compiled = {}
         TsRR = [R(T.subs(**params)) for T in Ts]
         super().__init__(R, vars, T0s, TsRR)
         
+    def with_initial_condition(self, x0):
+        '''A shallow copy of the model starting from x0, which shares the
+        already compiled vector field.'''
+        model = copy.copy(self)
+        model.T0s = x0
+        model.y0 = x0
+        return model
+
+    @property
+    def affine_system(self) -> Optional[AffineSystem]:
+        '''The affine form of the vector field, or None if it is not affine.'''
+        if 'affine_system' not in self._compiled:
+            self._compiled['affine_system'] = AffineSystem.from_model(self)
+        return self._compiled['affine_system']
+
     @property
     def fns(self):
         return [
@@ -55,6 +82,33 @@ class ParametricModel(lbuc.System, Model):
 class IntervalParametricModel(ParametricModel):
     """A LBUC System defined based on a parametric set of ODEs."""
     BaseField = RIF
+    # Optional persistent ReachCache used to memoize reach steps
+    reach_cache = None
+
+    @property
+    def integration_method(self):
+        return (lbuc.IntegrationMethod.NONPOLY_TAYLOR
+                if self.nonpoly
+                else lbuc.IntegrationMethod.LOW_DEGREE)
+
+    def step_reach(self, trun):
+        '''Take one continuous reachability step from the initial condition,
+        consulting the reach cache if there is one.'''
+        if self.linear_propagation and self.affine_system is not None:
+            return self.affine_system.reach(self.y0, trun)
+
+        if self.reach_cache is None:
+            return self.reach(trun, integration_method=self.integration_method)
+
+        if 'reach_cache_key' not in self._compiled:
+            self._compiled['reach_cache_key'] = self.reach_cache.model_key(
+                self, self.integration_method)
+        key = self._compiled['reach_cache_key']
+        reach = self.reach_cache.lookup(key, trun, self.y0)
+        if reach is None:
+            reach = self.reach(trun, integration_method=self.integration_method)
+            self.reach_cache.store(key, trun, self.y0, reach)
+        return reach
     
     def run_iter(self):
         x = self.T0s
@@ -65,10 +119,7 @@ class IntervalParametricModel(ParametricModel):
             trun, x, _ = (yield x)
             # print(f"running for {trun.str(style='brackets')} ...")
             # Take one continuous reachability step
-            reach = self.reach(trun,
-                integration_method=(lbuc.IntegrationMethod.NONPOLY_TAYLOR
-                    if self.nonpoly
-                    else lbuc.IntegrationMethod.LOW_DEGREE))
+            reach = self.step_reach(trun)
             yield reach
             x = reach(trun)
 
@@ -94,21 +145,29 @@ class NumericalParametricModel(ParametricModel):
         while True:
             # State does not matter
             trun, x, _ = (yield x)
-            print(f"running for {trun} ...")
+            # Hybrid simulations measure durations as intervals
+            trun = float(RIF(trun).center())
             # Compute numerical solution for one step
-            print(f"x = {x}")
-            sln = solve_ivp(
-                f,
-                (0, trun),
-                x,
-                method='LSODA',
-                jac=jac,
-                vectorized=True,
-                dense_output=True,
-            )
+            if self.linear_propagation and self.affine_system is not None:
+                sln = self.affine_system.solve(x, trun)
+            else:
+                sln = solve_ivp(
+                    f,
+                    (0, trun),
+                    x,
+                    method='LSODA',
+                    jac=jac,
+                    vectorized=True,
+                    dense_output=True,
+                )
             yield sln
             x = sln.sol(trun)
 
+    def ensemble(self, n_members: int, **kwargs) -> EnsembleSimulator:
+        '''A Monte Carlo ensemble of this model, sampled from its initial
+        set and interval parameters.'''
+        return EnsembleSimulator(self, n_members, **kwargs)
+
     @property
     def TraceType(cls):
         return NumericalContinuousTrace
@@ -117,14 +176,41 @@ class NumericalParametricModel(ParametricModel):
 class SwitchingParametricModel(Model):
     """A model which switches between multiple different parametric models based on the values of different state 
        variables."""
+    # Maximum number of compiled per-mode models to keep around
+    max_cached_models = 16
+    # Optional persistent ReachCache shared by the per-mode models
+    reach_cache = None
+    # Whether the per-mode models use linear propagation
+    linear_propagation = False
     
     def __init__(self, x0, **params):
         self.x0 = x0
         self.BaseField = x0[0].base_ring()
         self.params = params
+        self._model_cache = OrderedDict()
         
     def model_fn(self, x, state):
         raise NotImplementedError()
+
+    def mode_key(self, state):
+        '''The part of the discrete state which determines the vector field.
+        By default the whole state is used.'''
+        return tuple(sorted(state.items(), key=lambda kv: kv[0]))
+
+    def compiled_model(self, state):
+        '''The model for the mode of the given state, compiled once per mode
+        and kept in a LRU cache.'''
+        key = self.mode_key(state)
+        try:
+            model = self._model_cache[key]
+        except KeyError:
+            model = self.model_fn(self.x0, state)
+            self._model_cache[key] = model
+            if len(self._model_cache) > self.max_cached_models:
+                self._model_cache.popitem(last=False)
+        else:
+            self._model_cache.move_to_end(key)
+        return model
                 
     def run_iter(self):
         x = self.x0
@@ -133,8 +219,12 @@ class SwitchingParametricModel(Model):
         while True:
             trun, x, state = (yield x)
             trun = self.BaseField(trun)
-            # Take one continuous reachability step
-            gen = self.model_fn(x, state).run_iter()
+            # Take one continuous reachability step, only rebinding the
+            # initial condition of the compiled model for this mode
+            model = self.compiled_model(state).with_initial_condition(x)
+            model.reach_cache = self.reach_cache
+            model.linear_propagation = self.linear_propagation
+            gen = model.run_iter()
             next(gen)
             yield (res := gen.send((trun, x, state)))
             x = res(trun)
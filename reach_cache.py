@@ -0,0 +1,158 @@
+"""A persistent, content-addressed cache of continuous reachability steps."""
+
+import hashlib
+import itertools
+import os
+import pickle
+from collections import OrderedDict
+from typing import Any, Dict, List, Sequence
+
+from sage.all import RIF
+
+from .traces import exact_key, interval_bounds
+
+
+class ReachCache:
+    '''A disk-backed memo of reach steps, keyed by the model, the duration
+    of the step and its initial box.
+
+    Lookups are containment aware: a cached step from any initial box
+    containing the query box is a valid (if coarser) enclosure, and the
+    tightest such step is returned. Once the cached steps take up more than
+    max_bytes the least recently used are evicted.
+
+    The recency of the entries is kept in memory, and the index is written
+    every flush_every changes and on close (or on leaving a with block).'''
+
+    def __init__(self, path: str, max_bytes: int = 2**30,
+                 flush_every: int = 100):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.flush_every = flush_every
+        os.makedirs(os.path.join(path, 'entries'), exist_ok=True)
+        try:
+            with open(self.index_path, 'rb') as f:
+                self.index : Dict[str, List[Dict[str, Any]]] = pickle.load(f)
+        except FileNotFoundError:
+            self.index = {}
+        # The entries by file, from least to most recently used
+        self._recency : OrderedDict = OrderedDict(
+            (e['file'], (key, e)) for key, e in sorted(
+                ((key, e) for key, es in self.index.items() for e in es),
+                key=lambda x: x[1]['used'])
+        )
+        self._size = sum(e['size'] for _, e in self._recency.values())
+        self._clock = itertools.count(
+            max((e['used'] for _, e in self._recency.values()),
+                default=0) + 1)
+        self._changes = 0
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.path, 'index.pkl')
+
+    @staticmethod
+    def model_key(model, integration_method) -> str:
+        '''A hash of everything that determines a model's reach steps apart
+        from the initial box.'''
+        return hashlib.sha256(repr((
+            model.vs,
+            [exact_key(T) for T in model.y],
+            sorted((k, exact_key(v)) for k, v in model.params.items()),
+            str(integration_method),
+            model.nonpoly,
+        )).encode()).hexdigest()
+
+    @staticmethod
+    def step_key(model_key: str, duration: RIF) -> str:
+        return hashlib.sha256(
+            repr((model_key, interval_bounds([RIF(duration)]))).encode()
+        ).hexdigest()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def _use(self, entry):
+        entry['used'] = next(self._clock)
+        self._recency.move_to_end(entry['file'])
+
+    def _changed(self):
+        self._changes += 1
+        if self._changes >= self.flush_every:
+            self.flush()
+
+    def lookup(self, model_key: str, duration: RIF, box: Sequence[RIF]):
+        '''The cached reach step for the tightest initial box containing box,
+        or None on a cache miss.'''
+        bounds = interval_bounds(box)
+        candidates = [
+            e for e in self.index.get(self.step_key(model_key, duration), [])
+            if all(a <= c and d <= b
+                   for (a, b), (c, d) in zip(e['box'], bounds))
+        ]
+        if not candidates:
+            return None
+
+        entry = min(candidates,
+                    key=lambda e: sum(b - a for a, b in e['box']))
+        # The recency of the lookup is persisted for eviction by later runs
+        self._use(entry)
+        self._changed()
+        with open(os.path.join(self.path, 'entries', entry['file']), 'rb') as f:
+            return pickle.load(f)
+
+    def store(self, model_key: str, duration: RIF, box: Sequence[RIF], reach):
+        key = self.step_key(model_key, duration)
+        bounds = interval_bounds(box)
+        if any(e['box'] == bounds for e in self.index.get(key, [])):
+            return
+        try:
+            data = pickle.dumps(reach)
+        except (pickle.PicklingError, TypeError):
+            # Steps which cannot be serialised are simply not cached
+            return
+        file = hashlib.sha256(repr((key, bounds)).encode()).hexdigest() + '.pkl'
+        with open(os.path.join(self.path, 'entries', file), 'wb') as f:
+            f.write(data)
+
+        entry = {
+            'box': bounds,
+            'file': file,
+            'size': len(data),
+            'used': next(self._clock),
+        }
+        self.index.setdefault(key, []).append(entry)
+        self._recency[file] = (key, entry)
+        self._size += entry['size']
+        self.evict()
+        self._changed()
+
+    def evict(self):
+        '''Remove the least recently used entries until the cache fits in
+        max_bytes.'''
+        while self._size > self.max_bytes and self._recency:
+            _, (key, e) = self._recency.popitem(last=False)
+            self.index[key].remove(e)
+            if not self.index[key]:
+                del self.index[key]
+            os.remove(os.path.join(self.path, 'entries', e['file']))
+            self._size -= e['size']
+
+    def flush(self):
+        '''Write the index, including the recency of lookups, to disk.'''
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+        self._changes = 0
+
+    def close(self):
+        if self._changes:
+            self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
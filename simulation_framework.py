@@ -2,7 +2,7 @@ from abc import ABCMeta, abstractclassmethod, abstractmethod, abstractproperty
 
 from sage.all import RIF
 
-from .traces import Trace, DiscreteTrace, ContinuousTrace
+from .traces import Trace, DiscreteTrace, ContinuousTrace, Retention
 
 class Simulator(metaclass=ABCMeta):
     @abstractmethod
@@ -19,8 +19,9 @@ class Simulator(metaclass=ABCMeta):
 
 
 class Model(Simulator):
-    def run(self) -> ContinuousTrace:
-        return self.TraceType(RIF("[0, Inf]"), self.run_iter())
+    def run(self, retention: Retention = None) -> ContinuousTrace:
+        return self.TraceType(RIF("[0, Inf]"), self.run_iter(),
+                              retention=retention)
 
 
 class Controller(Simulator):
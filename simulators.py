@@ -1,36 +1,74 @@
+import itertools
+from typing import Optional
+
 from sage.all import RIF, RR, QQ
 import sage.all as sg
 from scipy.integrate import solve_ivp
 
+from .coalescing import coalesce_segments
+from .checkpoints import Checkpointer, SimulationState, load_checkpoint
 from .simulation_framework import Simulator
+from .stepping import AdaptiveTimeStep, adaptive_reach
+from .telemetry import StepEvent, Telemetry, enclosure_widths
 from .traces import (VerifiedContinuousTrace, NumericalContinuousTrace,
                      DiscreteTrace, VerifiedHybridTrace, NumericalHybridTrace,
-                     HybridTrace)
+                     HybridTrace, Retention)
 
 class VerifiedContinuousSimulator(Simulator):
     def __init__(self, state, model):
         self.state = state
         self.model = model
         
-    def run_iter(self, time_limit=RIF("Inf"), time_step=RIF("Inf")):
+    def run_iter(self, time_limit=RIF("Inf"), time_step=RIF("Inf"),
+                 telemetry: Optional[Telemetry] = None):
         # Model state
         t = RIF("0")
         x = None
+        step = 0
+        adaptive = isinstance(time_step, AdaptiveTimeStep)
         
         gen = self.model.run_iter()
+        if adaptive:
+            x = next(gen)
         
         while t.lower() < time_limit.lower():
-            run_duration = RIF(min(time_step.lower(), (time_limit - t).lower()), min(time_step.upper(), (time_limit - t).upper()))
-            
-            x = next(gen)
-            yield gen.send((run_duration, x, self.state))
+            if telemetry is not None:
+                reach_start = telemetry.clock()
+            if adaptive:
+                run_duration, reach, x, gen = adaptive_reach(
+                    gen, self.restart_model, x, self.state, time_step,
+                    time_limit - t)
+            else:
+                run_duration = RIF(min(time_step.lower(), (time_limit - t).lower()), min(time_step.upper(), (time_limit - t).upper()))
+                
+                x = next(gen)
+                reach = gen.send((run_duration, x, self.state))
+            if telemetry is not None:
+                telemetry.emit(StepEvent(
+                    'VerifiedContinuousSimulator', step, float(t.lower()),
+                    float(run_duration.upper()), None,
+                    telemetry.clock() - reach_start, enclosure_widths(reach),
+                    step + 1,
+                ))
+            yield reach
             
             t = t + run_duration
+            step += 1
+
+    def restart_model(self):
+        '''A fresh model generator, ready to be sent the next step.'''
+        gen = self.model.run_iter()
+        next(gen)
+        return gen
 
-    def run(self, start_time=RIF("0"), time_limit=RIF("Inf"), time_step=RIF("Inf")) -> VerifiedContinuousTrace:
+    def run(self, start_time=RIF("0"), time_limit=RIF("Inf"), time_step=RIF("Inf"),
+            retention: Optional[Retention] = None,
+            telemetry: Optional[Telemetry] = None) -> VerifiedContinuousTrace:
         return VerifiedContinuousTrace(
             RIF(start_time, start_time + time_limit),
-            self.run_iter(time_limit=time_limit, time_step=time_step),
+            self.run_iter(time_limit=time_limit, time_step=time_step,
+                          telemetry=telemetry),
+            retention=retention,
         )
 
     @property
@@ -43,26 +81,41 @@ class NumericalContinuousSimulator(Simulator):
         self.state = state
         self.model = model
         
-    def run_iter(self, time_limit=RR("Inf"), time_step=RR("Inf")):
+    def run_iter(self, time_limit=RR("Inf"), time_step=RR("Inf"),
+                 telemetry: Optional[Telemetry] = None):
         # Model state
         t = QQ(0)
         x = None
+        step = 0
         
         gen = self.model.run_iter()
         
         while t < time_limit:
             run_duration = min(time_step, (time_limit - t))
-            print(f"run_duration = {run_duration}")
                         
             x = next(gen)
-            yield gen.send((run_duration, x, self.state))
+            if telemetry is not None:
+                solve_start = telemetry.clock()
+            sln = gen.send((run_duration, x, self.state))
+            if telemetry is not None:
+                telemetry.emit(StepEvent(
+                    'NumericalContinuousSimulator', step, float(RIF(t).lower()),
+                    float(RIF(run_duration).upper()), None,
+                    telemetry.clock() - solve_start, None, step + 1,
+                ))
+            yield sln
             
             t = t + run_duration
+            step += 1
 
-    def run(self, start_time=RIF(0), time_limit=RIF("Inf"), time_step=RIF("Inf")) -> NumericalContinuousTrace:
+    def run(self, start_time=RIF(0), time_limit=RIF("Inf"), time_step=RIF("Inf"),
+            retention: Optional[Retention] = None,
+            telemetry: Optional[Telemetry] = None) -> NumericalContinuousTrace:
         return NumericalContinuousTrace(
             RIF(start_time, start_time + time_limit),
-            self.run_iter(time_limit=time_limit, time_step=time_step),
+            self.run_iter(time_limit=time_limit, time_step=time_step,
+                          telemetry=telemetry),
+            retention=retention,
         )
 
     @property
@@ -108,38 +161,141 @@ class HybridSimulator(Simulator):
                                       if controller_output_map is not None
                                       else (lambda xin, x: x))
         
-    def run_iter(self, time_limit=RIF('Inf'), time_step=RIF('Inf')):
-        # Model state
-        t = RIF("0")
-        
+    def run_iter(self, time_limit=RIF('Inf'), time_step=RIF('Inf'),
+                 resume_from: Optional[SimulationState] = None,
+                 checkpointer: Optional[Checkpointer] = None,
+                 telemetry: Optional[Telemetry] = None):
+        record = (checkpointer.record if checkpointer is not None
+                  else (lambda v: v))
+        step = segments = 0
+        # Adaptive steps are taken between controller events
+        adaptive = isinstance(time_step, AdaptiveTimeStep)
+        max_step = RIF('Inf') if adaptive else time_step
+
         model_gen = self.model.run_iter()
-        controller_gen = self.controller.run_iter()
         xin = x = next(model_gen)
-        yield (state := next(controller_gen))
+        if resume_from is None:
+            # Model state
+            t = RIF("0")
+            controller_gen = self.controller.run_iter()
+            yield record(state := next(controller_gen))
+        else:
+            # Continue from the state saved between two control steps, which
+            # has already been yielded by the original run
+            t = resume_from.t
+            xin = x = resume_from.x
+            controller_gen = self.controller.run_iter(resume_from.state)
+            state = next(controller_gen)
         
         # Use a suitable lower time limit for minimum simulation time to avoid failure
         # or loops at the end
         while 1e-5 <= time_limit.lower() - t.lower() and len(x) > 0:
             xin = x
             # print(f"x = {x}")
+            if telemetry is not None:
+                controller_start = telemetry.clock()
             next(controller_gen)
             trun, x, state = controller_gen.send(self.controller_input_map(x))
             x = self.controller_output_map(xin, x)
+            if telemetry is not None:
+                controller_time = telemetry.clock() - controller_start
+                reach_time = widths = None
             # print(f"state = {state}")
-            yield state
-            run_duration = RIF(min(trun.lower(), time_step.lower(), (time_limit - t).lower()),
-                               min(trun.upper(), time_step.upper(), (time_limit - t).upper()))
+            yield record(state)
+            run_duration = RIF(min(trun.lower(), max_step.lower(), (time_limit - t).lower()),
+                               min(trun.upper(), max_step.upper(), (time_limit - t).upper()))
             # Some time needs to pass for a continuous step
-            if run_duration.lower() > 1e-5:
-                yield model_gen.send((run_duration, x, state))
+            if run_duration.lower() > 1e-5 and adaptive:
+                elapsed = RIF(0)
+                while (run_duration - elapsed).lower() > 1e-5:
+                    if telemetry is not None:
+                        reach_start = telemetry.clock()
+                    duration, reach, x, model_gen = adaptive_reach(
+                        model_gen, self.restart_model, x, state, time_step,
+                        run_duration - elapsed)
+                    segments += 1
+                    if telemetry is not None:
+                        reach_time = ((reach_time or 0.0)
+                                      + telemetry.clock() - reach_start)
+                        widths = enclosure_widths(reach)
+                    yield record(reach)
+                    elapsed += duration
+            elif run_duration.lower() > 1e-5:
+                if telemetry is not None:
+                    reach_start = telemetry.clock()
+                reach = model_gen.send((run_duration, x, state))
+                segments += 1
+                if telemetry is not None:
+                    reach_time = telemetry.clock() - reach_start
+                    widths = enclosure_widths(reach)
+                yield record(reach)
                 x = next(model_gen)
+
+            if telemetry is not None:
+                telemetry.emit(StepEvent(
+                    'HybridSimulator', step, float(t.lower()),
+                    float(run_duration.upper()), controller_time, reach_time,
+                    widths, segments,
+                ))
             
             t = t + run_duration
+            step += 1
+            if checkpointer is not None:
+                checkpointer.step(t, x, state)
+
+        if checkpointer is not None:
+            checkpointer.step(t, x, state, force=True)
+            checkpointer.close()
+
+    def run(self, start_time=RIF(0), time_limit=RIF("Inf"), time_step=RIF("Inf"),
+            retention: Optional[Retention] = None,
+            checkpointer: Optional[Checkpointer] = None,
+            telemetry: Optional[Telemetry] = None,
+            width_budget: Optional[float] = None,
+            max_segments: Optional[int] = None) -> HybridTrace:
+        '''Run the simulation, eagerly unless a retention policy is given,
+        in which case the returned trace streams the run lazily. Given a
+        width_budget, runs of up to max_segments consecutive segments are
+        coalesced within it.'''
+        values = self.run_iter(time_limit=time_limit, time_step=time_step,
+                               checkpointer=checkpointer, telemetry=telemetry)
+        if width_budget is not None:
+            values = coalesce_segments(values, width_budget, max_segments)
+        return self.TraceType(
+            RIF(start_time, start_time + time_limit),
+            values,
+            retention=retention,
+        )
+
+    def restart_model(self):
+        '''A fresh model generator, ready to be sent the next step.'''
+        gen = self.model.run_iter()
+        next(gen)
+        return gen
+
+    def resume(self, path: str, start_time=RIF(0), time_limit=RIF("Inf"),
+               time_step=RIF("Inf"), checkpointer: Optional[Checkpointer] = None,
+               retention: Optional[Retention] = None,
+               telemetry: Optional[Telemetry] = None) -> HybridTrace:
+        '''Continue a run from the checkpoint saved at path up to the
+        (absolute) time_limit, optionally checkpointing the continued run.
+        The returned trace includes the segments saved in the checkpoint.
 
-    def run(self, start_time=RIF(0), time_limit=RIF("Inf"), time_step=RIF("Inf")) -> HybridTrace:
+        Resuming relies on the model taking its initial state from each
+        control step, as SwitchingParametricModel does.'''
+        sim_state = load_checkpoint(path)
+        if checkpointer is not None:
+            checkpointer.continue_from(sim_state)
         return self.TraceType(
             RIF(start_time, start_time + time_limit),
-            self.run_iter(time_limit=time_limit, time_step=time_step),
+            itertools.chain(
+                sim_state.segments,
+                self.run_iter(time_limit=time_limit, time_step=time_step,
+                              resume_from=sim_state,
+                              checkpointer=checkpointer,
+                              telemetry=telemetry),
+            ),
+            retention=retention,
         )
 
     @property
@@ -0,0 +1,82 @@
+"""Adaptive choice of reach step durations based on enclosure growth."""
+
+from typing import Callable
+
+from sage.all import RIF
+
+
+def box_width(x) -> float:
+    '''The width of the widest variable of a box.'''
+    return max((float(RIF(xi).absolute_diameter()) for xi in x), default=0.0)
+
+
+class AdaptiveTimeStep:
+    '''Chooses the duration of each reach step from the previous ones.
+
+    A step whose enclosure grew by more than width_tolerance is rejected
+    and retried with a shorter duration, and so is a step which failed to
+    integrate. The duration is lengthened again after steps which stay well
+    within the tolerance. Durations are always kept between min_step and
+    max_step.'''
+
+    def __init__(self, min_step, max_step, width_tolerance: float,
+                 initial_step=None, grow: float = 2.0, shrink: float = 0.5):
+        assert 0 < shrink < 1 < grow
+        self.min_step = float(RIF(min_step).lower())
+        self.max_step = float(RIF(max_step).upper())
+        self.width_tolerance = width_tolerance
+        self.grow = grow
+        self.shrink = shrink
+        self.step = (self.min_step if initial_step is None
+                     else float(RIF(initial_step).lower()))
+
+    def next_duration(self, max_duration: RIF) -> RIF:
+        '''The duration of the next step, which must not exceed
+        max_duration (e.g. the time until the next controller event).'''
+        if self.step < max_duration.lower():
+            return RIF(self.step)
+        return max_duration
+
+    def _shrink(self, duration: RIF) -> bool:
+        if duration.upper() <= self.min_step:
+            return False
+        self.step = max(self.min_step, float(duration.upper())*self.shrink)
+        return True
+
+    def accept(self, duration: RIF, width_before: float,
+               width_after: float) -> bool:
+        '''Record a successful step, returning whether it should be kept.'''
+        growth = width_after - width_before
+        if growth > self.width_tolerance and self._shrink(duration):
+            return False
+        if growth <= self.width_tolerance/4 and duration.lower() >= self.step:
+            self.step = min(self.max_step, self.step*self.grow)
+        return True
+
+    def failed(self, duration: RIF) -> bool:
+        '''Record a failed step, returning whether it should be retried.'''
+        return self._shrink(duration)
+
+
+def adaptive_reach(model_gen, restart: Callable, x, state,
+                   time_step: AdaptiveTimeStep, max_duration: RIF):
+    '''Take one adaptive reach step of at most max_duration from x.
+
+    model_gen must be waiting to be sent the next step, and restart()
+    returns a fresh model generator in the same condition, which replaces
+    model_gen if a step fails. Returns the duration of the step, its reach
+    set, the state at the end of the step and the model generator.'''
+    width_before = box_width(x)
+    while True:
+        duration = time_step.next_duration(max_duration)
+        try:
+            reach = model_gen.send((duration, x, state))
+        except Exception:
+            if not time_step.failed(duration):
+                raise
+            model_gen = restart()
+            continue
+
+        x_next = next(model_gen)
+        if time_step.accept(duration, width_before, box_width(x_next)):
+            return duration, reach, x_next, model_gen
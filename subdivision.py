@@ -0,0 +1,143 @@
+"""Verified simulation of subdivided initial sets in parallel."""
+
+import itertools
+from functools import partial
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from sage.all import RIF
+
+from .sweeps import ParameterSweep
+from .traces import (HybridTrace, VerifiedUnionTrace, is_numerical_segment,
+                     picklable_segment)
+
+
+def bisect_box(box: Sequence[RIF], i: Optional[int] = None) -> Tuple[list, list]:
+    '''Split a box in half along dimension i, by default the widest one.'''
+    if i is None:
+        i = max(range(len(box)), key=lambda j: box[j].absolute_diameter())
+    x = box[i]
+    lower, upper = list(box), list(box)
+    lower[i] = RIF(x.lower(), x.center())
+    upper[i] = RIF(x.center(), x.upper())
+    return lower, upper
+
+
+def subdivide_box(box: Sequence[RIF], divisions: Sequence[int]) -> List[list]:
+    '''Split a box uniformly into divisions[i] pieces along each dimension i.'''
+    assert len(divisions) == len(box)
+    pieces = []
+    for x, n in zip(box, divisions):
+        edges = [x.lower() + (x.upper() - x.lower())*k/n for k in range(n)]
+        pieces.append([
+            RIF(a, b) for a, b in zip(edges, edges[1:] + [x.upper()])
+        ])
+    return [list(b) for b in itertools.product(*pieces)]
+
+
+def final_width(trace) -> Optional[float]:
+    '''The width of the widest variable at the end of a verified trace, or
+    None if the trace is empty or numerical.'''
+    if isinstance(trace, HybridTrace):
+        trace = trace.continuous_part
+    if not len(trace.values) or is_numerical_segment(trace.values[-1]):
+        return None
+    r = trace.values[-1]
+    return max(float(x.absolute_diameter()) for x in r(r.time))
+
+
+def portable_trace(trace, resolution: Optional[float] = None):
+    '''The trace with any segments which cannot be pickled (to send them
+    back from a worker) replaced by boxes enclosing them.'''
+    return type(trace)(trace.domain, [
+        picklable_segment(v, resolution) for v in trace.values
+    ])
+
+
+def _box_scenario(simulator_factory, x0):
+    return simulator_factory([RIF(lower, upper) for lower, upper in x0])
+
+
+def _analyse_box(analyse, trace) -> tuple:
+    # The final width is measured on the original segments, before analyse
+    # replaces them
+    return analyse(trace), final_width(trace)
+
+
+class SubdividedSimulation:
+    '''Run the simulator simulator_factory(x0) over sub-boxes of the initial
+    box x0 in worker processes and merge the traces into a union trace.
+
+    With divisions, x0 is split uniformly once. Otherwise the sub-boxes are
+    bisected adaptively along their widest dimension, up to max_depth times,
+    while their run fails or its final enclosure is wider than
+    width_tolerance (the final width of numerical runs is not measured).
+    simulator_factory must be picklable, i.e. defined at module level.
+    Unless another analyse function is given, segments which cannot be
+    pickled are sent back from the workers as boxes over steps of at most
+    resolution seconds.'''
+
+    def __init__(self, simulator_factory: Callable, x0: Sequence[RIF],
+                 divisions: Optional[Sequence[int]] = None,
+                 width_tolerance: Optional[float] = None, max_depth: int = 4,
+                 run_kwargs: Optional[dict] = None,
+                 resolution: Optional[float] = 0.5, **sweep_kwargs):
+        self.simulator_factory = simulator_factory
+        self.x0 = list(x0)
+        self.divisions = divisions
+        self.width_tolerance = width_tolerance
+        self.max_depth = max_depth
+        self.run_kwargs = run_kwargs if run_kwargs is not None else {}
+        # Traces are sent back from the workers, so must be picklable
+        analyse = sweep_kwargs.pop('analyse', None)
+        if analyse is None:
+            analyse = partial(portable_trace, resolution=resolution)
+        sweep_kwargs['analyse'] = partial(_analyse_box, analyse)
+        self.sweep_kwargs = sweep_kwargs
+
+    def run_boxes(self, boxes):
+        '''Simulate each box in parallel, returning the sweep results in the
+        same order as the boxes. The value of each result is the analysed
+        trace together with its final width.'''
+        return ParameterSweep(
+            partial(_box_scenario, self.simulator_factory),
+            # Interval endpoints are floats, so they round trip exactly
+            ({'x0': [(float(x.lower()), float(x.upper())) for x in box]}
+             for box in boxes),
+            run_kwargs=self.run_kwargs,
+            **self.sweep_kwargs,
+        ).run()
+
+    def run_traces(self) -> list:
+        if self.divisions is not None:
+            results = self.run_boxes(subdivide_box(self.x0, self.divisions))
+            for result in results:
+                if not result.ok:
+                    raise RuntimeError(
+                        f"Simulation of sub-box failed:\n{result.error}")
+            return [result.value[0] for result in results]
+
+        traces = []
+        boxes = [self.x0]
+        for depth in itertools.count():
+            refine = []
+            for box, result in zip(boxes, self.run_boxes(boxes)):
+                trace, width = result.value if result.ok else (None, None)
+                if result.ok and (self.width_tolerance is None
+                                  or width is None
+                                  or width <= self.width_tolerance):
+                    traces.append(trace)
+                elif depth < self.max_depth:
+                    refine.extend(bisect_box(box))
+                elif result.ok:
+                    # Accept the best enclosure we could compute
+                    traces.append(trace)
+                else:
+                    raise RuntimeError(
+                        f"Simulation of sub-box failed:\n{result.error}")
+            if not refine:
+                return traces
+            boxes = refine
+
+    def run(self) -> VerifiedUnionTrace:
+        traces = self.run_traces()
+        return VerifiedUnionTrace(traces[0].domain, traces)
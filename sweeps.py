@@ -0,0 +1,252 @@
+"""Running simulation scenarios over grids of parameters in a process pool."""
+
+import itertools
+import multiprocessing
+import os
+import signal
+import time
+import traceback
+from collections import deque
+from concurrent.futures import (FIRST_COMPLETED, Future, ProcessPoolExecutor,
+                                wait)
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+
+def parameter_grid(**axes) -> List[Dict[str, Any]]:
+    '''The cartesian product of the given parameter axes, e.g.
+    parameter_grid(C_H=["243.45802367", "250.0"], n_samples_heating=[1, 2]).'''
+    keys = list(axes)
+    return [
+        dict(zip(keys, vs))
+        for vs in itertools.product(*(axes[k] for k in keys))
+    ]
+
+
+class ScenarioResult:
+    '''The outcome of running a single scenario of a sweep. On failure value
+    is None and error holds the formatted exception.'''
+
+    def __init__(self, index: int, params: Dict[str, Any], value=None,
+                 error: Optional[str] = None, elapsed: Optional[float] = None):
+        self.index = index
+        self.params = params
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self):
+        return (f"ScenarioResult({self.index}, {self.params}, "
+                f"{'ok' if self.ok else 'failed'})")
+
+
+def _run_scenario(scenario_factory, index, params, run_kwargs,
+                  analyse) -> ScenarioResult:
+    start = time.perf_counter()
+    try:
+        # The simulator is constructed inside the worker so that only the
+        # factory and its parameters need to be pickled
+        trace = scenario_factory(**params).run(**run_kwargs)
+        value = trace if analyse is None else analyse(trace)
+        return ScenarioResult(index, params, value=value,
+                              elapsed=time.perf_counter() - start)
+    except Exception:
+        return ScenarioResult(index, params, error=traceback.format_exc(),
+                              elapsed=time.perf_counter() - start)
+
+
+def _run_chunk(scenario_factory, chunk, run_kwargs,
+               analyse) -> List[ScenarioResult]:
+    return [
+        _run_scenario(scenario_factory, index, params, run_kwargs, analyse)
+        for index, params in chunk
+    ]
+
+
+def _failed(chunk, error: str) -> List[ScenarioResult]:
+    return [ScenarioResult(index, params, error=error)
+            for index, params in chunk]
+
+
+def _report_pid(pids):
+    pids.put(os.getpid())
+
+
+class _WorkerPool:
+    '''A process pool whose workers can be killed, including any which are
+    stuck inside a long running computation.'''
+
+    def __init__(self, max_workers: int, mp_context=None):
+        if mp_context is None:
+            mp_context = multiprocessing.get_context()
+        # Workers report their PIDs as they start, so that they can be
+        # killed where the pool cannot do so itself
+        self._pids = mp_context.SimpleQueue()
+        self.executor = ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=mp_context,
+            initializer=_report_pid, initargs=(self._pids,))
+
+    def submit(self, *args) -> Future:
+        return self.executor.submit(*args)
+
+    def terminate(self):
+        terminate = getattr(self.executor, 'terminate_workers', None)
+        if terminate is not None:
+            terminate()
+        else:
+            # ProcessPoolExecutor only has terminate_workers from Python
+            # 3.14, so kill the workers which reported starting. They only
+            # exit when the pool shuts down, so the PIDs are not reused.
+            while not self._pids.empty():
+                try:
+                    os.kill(self._pids.get(), signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class ParameterSweep:
+    '''Run the simulator returned by scenario_factory(**params) for each
+    params in grid across a pool of worker processes.
+
+    The scenario_factory and analyse functions must be picklable, i.e.
+    defined at module level, and the parameters should be plain values
+    (e.g. strings rather than RIFs). The trace of each run is passed through
+    analyse inside the worker, so that only its (ideally small) result is
+    sent back. Each scenario is limited to timeout seconds, and failures
+    (including timeouts and crashed workers) are reported in the
+    corresponding ScenarioResult rather than aborting the sweep.'''
+
+    def __init__(self, scenario_factory: Callable, grid: Iterable[Dict[str, Any]],
+                 run_kwargs: Optional[Dict[str, Any]] = None,
+                 analyse: Optional[Callable] = None,
+                 max_workers: Optional[int] = None, chunksize: int = 1,
+                 timeout: Optional[float] = None, mp_context=None):
+        assert chunksize >= 1
+        self.scenario_factory = scenario_factory
+        self.grid = list(grid)
+        self.run_kwargs = run_kwargs if run_kwargs is not None else {}
+        self.analyse = analyse
+        self.max_workers = max_workers
+        self.chunksize = chunksize
+        self.timeout = timeout
+        self.mp_context = mp_context
+
+    @property
+    def chunks(self):
+        scenarios = list(enumerate(self.grid))
+        return [
+            scenarios[i:i + self.chunksize]
+            for i in range(0, len(scenarios), self.chunksize)
+        ]
+
+    @property
+    def n_workers(self) -> int:
+        return self.max_workers if self.max_workers is not None else (
+            os.cpu_count() or 1)
+
+    def run_iter(self):
+        '''Yield the result of each scenario as soon as its chunk finishes.
+
+        Timeouts and crashes are handled by the parent process: only as many
+        chunks as there are workers are in flight, so that each has a
+        deadline, and a pool with an overdue or crashed worker is killed
+        and replaced. The other chunks which were in flight are resubmitted.
+        After a crash, they are run one scenario at a time, so that only
+        the scenario responsible fails.'''
+        queue = deque(self.chunks)
+        # Chunks to run on their own, without any others in flight
+        isolated : Deque[list] = deque()
+        executor : Optional[_WorkerPool] = None
+        # The chunk, deadline and isolation of each running future
+        in_flight : Dict[Future, Tuple[list, Optional[float], bool]] = {}
+
+        def submit(chunk, alone):
+            deadline = (None if self.timeout is None
+                        else time.monotonic() + self.timeout*len(chunk))
+            future = executor.submit(_run_chunk, self.scenario_factory, chunk,
+                                     self.run_kwargs, self.analyse)
+            in_flight[future] = (chunk, deadline, alone)
+
+        def requeue():
+            for chunk, _, alone in in_flight.values():
+                (isolated if alone else queue).appendleft(chunk)
+            in_flight.clear()
+
+        try:
+            while queue or isolated or in_flight:
+                if executor is None:
+                    executor = _WorkerPool(self.n_workers, self.mp_context)
+                if isolated:
+                    if not in_flight:
+                        submit(isolated.popleft(), alone=True)
+                else:
+                    while queue and len(in_flight) < self.n_workers:
+                        submit(queue.popleft(), alone=False)
+
+                deadlines = [d for _, d, _ in in_flight.values()
+                             if d is not None]
+                done, _ = wait(
+                    in_flight,
+                    timeout=(max(0.0, min(deadlines) - time.monotonic())
+                             if deadlines else None),
+                    return_when=FIRST_COMPLETED,
+                )
+
+                broken = False
+                for future in done:
+                    chunk, _, alone = in_flight.pop(future)
+                    try:
+                        results = future.result()
+                    except BrokenProcessPool:
+                        # A worker died (e.g. crashed inside Sage), and the
+                        # pool cannot tell which chunk it was running
+                        broken = True
+                        if alone and len(chunk) == 1:
+                            results = _failed(chunk, traceback.format_exc())
+                        else:
+                            isolated.extend([scenario] for scenario in chunk)
+                            results = []
+                    except Exception:
+                        results = _failed(chunk, traceback.format_exc())
+                    yield from results
+
+                if broken:
+                    for chunk, _, _ in in_flight.values():
+                        isolated.extend([scenario] for scenario in chunk)
+                    in_flight.clear()
+                    executor.terminate()
+                    executor = None
+                    continue
+
+                now = time.monotonic()
+                overdue = [future for future, (_, d, _) in in_flight.items()
+                           if d is not None and d <= now]
+                if overdue:
+                    for future in overdue:
+                        chunk, _, _ = in_flight.pop(future)
+                        if len(chunk) == 1:
+                            yield from _failed(chunk, (
+                                f"ScenarioTimeout: exceeded {self.timeout}s"))
+                        else:
+                            # Find out which of the scenarios is too slow
+                            isolated.extend([scenario] for scenario in chunk)
+                    requeue()
+                    executor.terminate()
+                    executor = None
+        finally:
+            if executor is not None:
+                if in_flight:
+                    executor.terminate()
+                else:
+                    executor.shutdown()
+
+    def run(self) -> List[ScenarioResult]:
+        return sorted(self.run_iter(), key=lambda r: r.index)
@@ -0,0 +1,123 @@
+"""Per-step telemetry events emitted by the simulators to pluggable sinks.
+
+Simulators only emit events when they are given a Telemetry object, so that
+disabled telemetry costs a single comparison per step."""
+
+import json
+import time
+from typing import Callable, IO, List, Optional, Union
+
+from .traces import is_numerical_segment
+
+
+class StepEvent:
+    '''Timings and sizes for one step of a simulation.'''
+    __slots__ = ('simulator', 'step', 'time', 'duration', 'controller_time',
+                 'reach_time', 'widths', 'segments')
+
+    def __init__(self, simulator: str, step: int, time: float,
+                 duration: float, controller_time: Optional[float],
+                 reach_time: Optional[float], widths: Optional[List[float]],
+                 segments: int):
+        self.simulator = simulator
+        self.step = step
+        # Simulation time at the start of the step
+        self.time = time
+        self.duration = duration
+        # Wall time spent in the controller and the continuous step
+        self.controller_time = controller_time
+        self.reach_time = reach_time
+        # Width of each variable at the end of the step
+        self.widths = widths
+        self.segments = segments
+
+    def as_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __repr__(self):
+        return f"StepEvent({self.as_dict()})"
+
+
+def enclosure_widths(segment) -> Optional[List[float]]:
+    '''The width of each variable at the end of a verified segment.'''
+    if is_numerical_segment(segment):
+        return None
+    return [float(x.absolute_diameter()) for x in segment(segment.time)]
+
+
+class Sink:
+    def emit(self, event: StepEvent):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class CounterSink(Sink):
+    '''Accumulates totals and maxima in memory.'''
+
+    def __init__(self):
+        self.steps = 0
+        self.segments = 0
+        self.controller_time = 0.0
+        self.reach_time = 0.0
+        self.max_reach_time = 0.0
+        self.max_widths : Optional[List[float]] = None
+
+    def emit(self, event: StepEvent):
+        self.steps += 1
+        self.segments = event.segments
+        self.controller_time += event.controller_time or 0.0
+        self.reach_time += event.reach_time or 0.0
+        self.max_reach_time = max(self.max_reach_time, event.reach_time or 0.0)
+        if event.widths is not None:
+            self.max_widths = (event.widths if self.max_widths is None
+                               else [max(a, b) for a, b in
+                                     zip(self.max_widths, event.widths)])
+
+
+class JsonLinesSink(Sink):
+    '''Writes each event as a line of JSON to a path or open file.'''
+
+    def __init__(self, file: Union[str, IO[str]]):
+        self._owned = isinstance(file, str)
+        self.file = open(file, 'a') if isinstance(file, str) else file
+
+    def emit(self, event: StepEvent):
+        self.file.write(json.dumps(event.as_dict()) + '\n')
+
+    def close(self):
+        if self._owned:
+            self.file.close()
+        else:
+            self.file.flush()
+
+
+class ProfilerSink(Sink):
+    '''Calls hook with each event whose continuous step took at least
+    threshold seconds, e.g. to log or profile stiff segments.'''
+
+    def __init__(self, hook: Callable[[StepEvent], None],
+                 threshold: float = 0.0):
+        self.hook = hook
+        self.threshold = threshold
+
+    def emit(self, event: StepEvent):
+        if (event.reach_time or 0.0) >= self.threshold:
+            self.hook(event)
+
+
+class Telemetry:
+    '''Delivers step events to a collection of sinks.'''
+
+    def __init__(self, *sinks: Sink):
+        self.sinks = list(sinks)
+        self.clock = time.perf_counter
+
+    def emit(self, event: StepEvent):
+        for sink in self.sinks:
+            sink.emit(event)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
@@ -1,10 +1,18 @@
 import abc
+import bisect
+import itertools
+import os
+import pickle
+from collections.abc import Sequence
 from typing import Any, Dict, List, Optional, Union, Iterable, Tuple
 from typing_extensions import TypeAlias
 from functools import partial
 
+import numpy as np
 from scipy.integrate import OdeSolution
 from sage.all import RIF
+from sage.rings.real_mpfi import RealIntervalFieldElement
+from sage.symbolic.expression import Expression
 import sage.all as sg
 
 import lbuc
@@ -19,27 +27,432 @@ VerifiedHybridState: TypeAlias = Union[DiscreteState, ContinuousState]
 NumericalHybridState: TypeAlias = Union[DiscreteState, NumericalState]
 
 
+class ReachSegment(metaclass=abc.ABCMeta):
+    '''A verified continuous segment of duration time, which can be called
+    with a (local) time interval to enclose the state over that interval.
+    lbuc.Reach is a virtual subclass.'''
+    # Names of the state variables
+    vs : List[str] = []
+    time : RIF
+    # The discrete states entered during segments which merge several steps
+    # (see coalescing), with their offsets from the start of the segment
+    events : List[Tuple[RIF, dict]] = []
+
+    @abc.abstractmethod
+    def __call__(self, t) -> List[RIF]:
+        raise NotImplementedError()
+
+    def sage_tube_plot(self, tvar: str, v: str, step=0.5, color='blue',
+                       straight=True, joins=False, **kwargs) -> 'sg.Graphics':
+        '''Plot boxes enclosing variable v against tvar (a state variable
+        or, failing that, the local time) over each step of the segment.'''
+        end = float(RIF(self.time).upper())
+        starts = np.append(np.arange(0.0, end, step), end)
+        i = self.vs.index(v)
+        g = sg.Graphics()
+        for a, b in zip(starts, starts[1:]):
+            tt = RIF(a, b)
+            y = self(tt)
+            x = y[self.vs.index(tvar)] if tvar in self.vs else tt
+            g.add_primitive(sg.polygon(
+                [(x.lower(), y[i].lower()), (x.upper(), y[i].lower()),
+                 (x.upper(), y[i].upper()), (x.lower(), y[i].upper())],
+                color=color, **kwargs,
+            )[0])
+        return g
+
+
+ReachSegment.register(lbuc.Reach)
+
+
+def segment_boxes(r: ReachSegment, resolution: Optional[float]) -> np.ndarray:
+    '''Boxes enclosing a segment over consecutive local time steps of at
+    most resolution seconds, followed by its state at the end, as an array
+    of shape (n_boxes, 1 + n_vars, 2) whose first column holds the time
+    interval of each box.'''
+    time = RIF(r.time)
+    end = float(time.upper())
+    if resolution is None or resolution >= end:
+        starts = np.array([0.0, end])
+    else:
+        starts = np.append(np.arange(0.0, end, resolution), end)
+    steps = [RIF(a, b) for a, b in zip(starts, starts[1:])] + [time]
+
+    boxes = np.empty((len(steps), 1 + len(r.vs), 2))
+    for i, tt in enumerate(steps):
+        for j, x in enumerate([tt] + list(r(tt))):
+            x = RIF(x)
+            boxes[i, j] = float(x.lower()), float(x.upper())
+    return boxes
+
+
+class BoxSegment(ReachSegment):
+    '''A segment represented by boxes enclosing it over consecutive time
+    steps (see segment_boxes), which encloses the state over a (local) time
+    interval by the union of the boxes which overlap it, or at the end of
+    the segment by the final box alone.'''
+
+    def __init__(self, vs: List[str], time: RIF, boxes: np.ndarray):
+        self.vs = vs
+        self.time = time
+        self._boxes = boxes
+
+    @classmethod
+    def from_segment(cls, r: ReachSegment,
+                     resolution: Optional[float] = None) -> 'BoxSegment':
+        return cls(list(r.vs), RIF(r.time), segment_boxes(r, resolution))
+
+    @property
+    def boxes(self) -> np.ndarray:
+        return self._boxes
+
+    def __call__(self, t) -> List[RIF]:
+        t = RIF(t)
+        boxes = self.boxes
+        end = boxes[-1]
+        if end[0, 0] <= float(t.lower()) and float(t.upper()) <= end[0, 1]:
+            return [RIF(a, b) for a, b in end[1:]]
+        overlapping = ((boxes[:, 0, 0] <= float(t.upper()))
+                       & (boxes[:, 0, 1] >= float(t.lower())))
+        if not overlapping.any():
+            raise ValueError(f"Time {t.str(style='brackets')} is outside of "
+                             f"the segment")
+        lo = boxes[overlapping, 1:, 0].min(axis=0)
+        hi = boxes[overlapping, 1:, 1].max(axis=0)
+        return [RIF(a, b) for a, b in zip(lo, hi)]
+
+
+# Whether segments of each type can be pickled
+_picklable_types : Dict[type, bool] = {}
+
+
+def picklable_segment(v, resolution: Optional[float] = None):
+    '''v itself if it can be pickled, and otherwise (for segments) a
+    BoxSegment enclosing it. Whether a type of segment pickles is only
+    checked for its first instance.'''
+    if not isinstance(v, ReachSegment) or isinstance(v, BoxSegment):
+        return v
+    if type(v) not in _picklable_types:
+        try:
+            pickle.dumps(v)
+            _picklable_types[type(v)] = True
+        except Exception:
+            _picklable_types[type(v)] = False
+    return (v if _picklable_types[type(v)]
+            else BoxSegment.from_segment(v, resolution))
+
+
+def interval_bounds(xs: Sequence[RIF]) -> tuple:
+    # Interval endpoints are floats, so this is exact
+    return tuple((float(x.lower()), float(x.upper())) for x in xs)
+
+
+def exact_key(x):
+    '''A hashable representation of a number, polynomial or symbolic
+    expression. Unlike str, which prints intervals with only their certain
+    digits, this keeps the exact endpoints of intervals.'''
+    if isinstance(x, RealIntervalFieldElement):
+        return ('interval',) + interval_bounds([x])[0]
+    if isinstance(x, Expression):
+        if x.operator() is None:
+            return (exact_key(x.pyobject()) if x.is_numeric()
+                    else ('symbol', str(x)))
+        return (str(x.operator()),) + tuple(exact_key(o) for o in x.operands())
+    if hasattr(x, 'dict') and hasattr(x, 'parent'):
+        # A polynomial, by its exponents and coefficients
+        return ('polynomial', str(x.parent()), tuple(sorted(
+            ((tuple(e) if hasattr(e, '__iter__') else e), exact_key(c))
+            for e, c in x.dict().items()
+        )))
+    return ('value', str(x))
+
+
+def segment_events(v) -> List[Tuple[RIF, dict]]:
+    '''The discrete states entered during a segment, with their offsets from
+    its start. In a trace, these states precede the segment.'''
+    # lbuc.Reach is only a virtual subclass, so has no events
+    return v.events if ReachSegment in type(v).__mro__ else []
+
+
+def is_numerical_segment(v) -> bool:
+    '''Whether v is a numerical segment. solve_ivp results are dicts, so
+    these cannot be told apart from discrete states by type alone.'''
+    return isinstance(v, OdeSolution) or hasattr(v, 'sol')
+
+
+def segment_duration(v) -> RIF:
+    '''The duration of a numerical segment.'''
+    sol = dense_output(v)
+    return RIF(sol.t_max - sol.t_min)
+
+
+def dense_output(v) -> OdeSolution:
+    '''The dense output of a numerical segment, which may either be an
+    OdeSolution or the result returned by solve_ivp.'''
+    return v if isinstance(v, OdeSolution) else v.sol
+
+
+class RetainedValues(Sequence):
+    '''The values of a streamed trace held in memory, as a list with a head
+    offset, so that values are evicted from the front and indexed in O(1).
+    The list is compacted once evicted entries make up half of it.
+
+    start is the position in the whole run of the first retained value.'''
+
+    def __init__(self):
+        self._items : List[Any] = []
+        self._head = 0
+        self.start = 0
+
+    def __len__(self) -> int:
+        return len(self._items) - self._head
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._items[self._head + j]
+                    for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._items[self._head + i]
+
+    def __iter__(self):
+        return itertools.islice(self._items, self._head, None)
+
+    def at(self, p: int):
+        '''The value at position p of the whole run.'''
+        if p < self.start:
+            raise IndexError(f"Value {p} has been evicted from the trace")
+        return self[p - self.start]
+
+    def append(self, v):
+        self._items.append(v)
+
+    def popleft(self):
+        if not len(self):
+            raise IndexError("No values are retained")
+        v = self._items[self._head]
+        self._items[self._head] = None
+        self._head += 1
+        self.start += 1
+        if 2*self._head >= len(self._items):
+            del self._items[:self._head]
+            self._head = 0
+        return v
+
+
+class SequenceView(Sequence):
+    '''A read-only view of the entries of values at the given positions,
+    which sees positions appended to the underlying list.
+
+    Positions into the RetainedValues of a streamed trace are positions in
+    the whole run, so a view stays valid as values are evicted, except that
+    evicted values raise an IndexError.'''
+
+    def __init__(self, values, positions: List[int]):
+        self._base = values
+        self.positions = positions
+
+    def _at(self, p: int):
+        if isinstance(self._base, RetainedValues):
+            return self._base.at(p)
+        return self._base[p]
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._at(p) for p in self.positions[i]]
+        return self._at(self.positions[i])
+
+    def __iter__(self):
+        for p in self.positions:
+            yield self._at(p)
+
+
+def indexable(values):
+    '''values as a sequence supporting fast indexing and slicing.'''
+    return (values
+            if isinstance(values, (list, SequenceView, RetainedValues))
+            else list(values))
+
+
+def evaluate_segments(ts, boundaries: np.ndarray, n_vars: int,
+                      evaluate_segment) -> np.ndarray:
+    '''The states at each of the absolute times ts of a trace whose
+    segments are delimited by boundaries, as an array of shape
+    (n_times, n_vars) which is NaN outside of the trace.
+    evaluate_segment(k, ts) evaluates segment k at the times ts within it,
+    which are grouped so that each segment is evaluated once.'''
+    ts = np.asarray(ts, dtype=float).reshape(-1)
+    n_segments = len(boundaries) - 1
+    ys = np.full((len(ts), n_vars), np.nan)
+    if n_segments <= 0:
+        return ys
+
+    ks = np.searchsorted(boundaries, ts, side='right') - 1
+    # The end of the trace belongs to the last segment
+    ks[ts == boundaries[-1]] = n_segments - 1
+
+    inside = (ks >= 0) & (ks < n_segments)
+    for k in np.unique(ks[inside]):
+        mask = ks == k
+        ys[mask] = evaluate_segment(k, ts[mask])
+    return ys
+
+
+def evaluate_dense_output(sols: List[OdeSolution], boundaries: np.ndarray,
+                          k: int, ts: np.ndarray) -> np.ndarray:
+    '''Evaluate the dense output of segment k at the absolute times ts.'''
+    sol = sols[k]
+    return np.reshape(sol(ts - boundaries[k] + sol.t_min), (-1, len(ts))).T
+
+
+class Retention:
+    '''Bounds the part of a streamed trace which is kept in memory.
+
+    At most max_segments values are retained, or just enough of the most
+    recent values to cover time_window. Evicted values are dropped, or
+    pickled into spill_dir if it is given. Segments which cannot be pickled
+    are spilled (and so come back) as BoxSegments over steps of at most
+    resolution seconds.'''
+
+    def __init__(self, max_segments: Optional[int] = None, time_window=None,
+                 spill_dir: Optional[str] = None,
+                 resolution: Optional[float] = None):
+        assert max_segments is None or max_segments >= 1
+        self.max_segments = max_segments
+        self.time_window = (None if time_window is None
+                            else RIF(time_window).upper())
+        self.spill_dir = spill_dir
+        self.resolution = resolution
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def should_evict(self, n_retained: int, retained_span: float,
+                     oldest_span: float) -> bool:
+        if self.max_segments is not None and n_retained > self.max_segments:
+            return True
+        return (self.time_window is not None
+                and retained_span - oldest_span >= self.time_window)
+
+    def spill_path(self, i: int) -> str:
+        return os.path.join(self.spill_dir, f"{i:010d}.pkl")
+
+
 class Trace(metaclass=abc.ABCMeta):
-    def __init__(self, values: Iterable[Any]):
-        self._values : List[Any] = list(values)
+    def __init__(self, values: Iterable[Any],
+                 retention: Optional[Retention] = None):
+        self._retention = retention
+        self._n_evicted = 0
+        self._evicted_time = RIF(0)
+        if retention is None:
+            # Eagerly consume the whole run
+            self._source = None
+            # Views of another trace's values are used without copying
+            self._values : List[Any] = (values
+                                        if isinstance(values, SequenceView)
+                                        else list(values))
+            for v in self._values:
+                self._check_value(v)
+        else:
+            # Pull values from the run on demand, keeping only those values
+            # allowed by the retention policy
+            self._source = iter(values)
+            self._values = RetainedValues()
+            self._retained_span = 0.0
+
+    def _check_value(self, v):
+        pass
+
+    def _segment_duration(self, v) -> RIF:
+        return RIF(0)
 
     def __iter__(self):
-        yield from self._values
+        if self._retention is None:
+            yield from self._values
+            return
+        # Copy, since pulling further values may evict retained ones
+        yield from list(self._values)
+        while self.advance():
+            yield self._values[-1]
 
     @property
     def values(self):
         return self._values
 
+    @property
+    def streaming(self) -> bool:
+        return self._retention is not None
+
+    @property
+    def exhausted(self) -> bool:
+        return self._source is None
+
+    def advance(self) -> bool:
+        '''Pull the next value of a streamed trace into memory, returning
+        False once the run has finished.'''
+        if self._source is None:
+            return False
+        try:
+            v = next(self._source)
+        except StopIteration:
+            self._source = None
+            return False
+        self._check_value(v)
+        self._values.append(v)
+        self._retained_span += self._segment_duration(v).upper()
+        self._evict()
+        return True
+
+    def advance_until(self, t) -> bool:
+        '''Pull values from a streamed trace until it covers time t,
+        returning False if the run finished first.'''
+        if self._retention is None:
+            return True
+        while (self._evicted_time.lower() + self._retained_span
+               < RIF(t).upper()):
+            if not self.advance():
+                return False
+        return True
+
+    def _evict(self):
+        while len(self._values) > 1 and self._retention.should_evict(
+                len(self._values), self._retained_span,
+                self._segment_duration(self._values[0]).upper()):
+            v = self._values.popleft()
+            duration = self._segment_duration(v)
+            self._retained_span -= duration.upper()
+            self._evicted_time += duration
+            if self._retention.spill_dir is not None:
+                with open(self._retention.spill_path(self._n_evicted),
+                          'wb') as f:
+                    pickle.dump(picklable_segment(v, self._retention.resolution),
+                                f)
+            self._n_evicted += 1
+
+    def spilled_values(self):
+        '''Reload the values which have been spilled to disk, where
+        segments which could not be pickled are BoxSegments.'''
+        if self._retention is None or self._retention.spill_dir is None:
+            return
+        for i in range(self._n_evicted):
+            with open(self._retention.spill_path(i), 'rb') as f:
+                yield pickle.load(f)
+
 
 class DiscreteTrace(Trace):
-    def __init__(self, values: Iterable):
-        assert all(isinstance(v, dict) for v in values)
+    def _check_value(self, v):
+        assert isinstance(v, dict)
 
 
 class RealTimeTrace(Trace, metaclass=abc.ABCMeta):
-    def __init__(self, domain: RIF, values):
+    def __init__(self, domain: RIF, values,
+                 retention: Optional[Retention] = None):
         self._domain = domain
-        super().__init__(values)
+        super().__init__(values, retention)
 
     @property
     def domain(self) -> RIF:
@@ -49,6 +462,17 @@ class RealTimeTrace(Trace, metaclass=abc.ABCMeta):
     def time(self) -> RIF:
         return self.domain.upper()
 
+    @property
+    def retained_start(self) -> RIF:
+        '''The start time of the values currently held in memory.'''
+        return self.domain.edges()[0] + self._evicted_time
+
+    @property
+    def retained_domain(self) -> RIF:
+        if self._n_evicted == 0:
+            return self.domain
+        return RIF(self.retained_start.lower(), self.domain.upper())
+
     def __call__(self, t) -> Any:
         raise NotImplementedError()
 
@@ -62,12 +486,47 @@ class ContinuousTrace(RealTimeTrace, metaclass=abc.ABCMeta):
 
 
 class VerifiedContinuousTrace(ContinuousTrace):
-    def __init__(self, domain: RIF, values: Iterable[ContinuousState]):
-        values = list(values)
-        assert all(isinstance(v, lbuc.Reach) for v in values)
-        super().__init__(domain, values)
+    def __init__(self, domain: RIF, values: Iterable[ContinuousState],
+                 retention: Optional[Retention] = None):
+        self._index_evicted = None
+        super().__init__(domain, values, retention)
+
+    def _check_value(self, v):
+        assert isinstance(v, ReachSegment)
+
+    def _segment_index(self):
+        '''The start time of each retained segment, together with the lower
+        edges of the starts and upper edges of the ends used for bisection.
+        The index is extended as values are streamed in and rebuilt after
+        evictions.'''
+        if self._index_evicted != self._n_evicted:
+            self._index_evicted = self._n_evicted
+            self._starts, self._start_lowers, self._end_uppers = [], [], []
+            self._next_start = self.retained_start
+        n = len(self._starts)
+        for r in (self.values[n:] if len(self.values) > n else ()):
+            t0 = self._next_start
+            self._starts.append(t0)
+            self._start_lowers.append(t0.lower())
+            self._end_uppers.append((t0 + RIF(0, r.time)).upper())
+            self._next_start = t0 + RIF(r.time)
+        return self._starts, self._start_lowers, self._end_uppers
+
+    def _segment_duration(self, v) -> RIF:
+        return RIF(v.time)
+
+    def plot(self, variables: Tuple[str], resolution: Optional[int] = None,
+             window=None, **kwargs) -> 'sg.Graphics':
+        '''Plot tubes enclosing each of the variables over time.
+
+        Given a resolution (e.g. the width of the plot in pixels), the time
+        window is split into that many buckets, and the hull of the
+        segments in each bucket is drawn as a single polygon per variable.
+        Otherwise, if a window is given, the segments in the window are
+        drawn in full detail.'''
+        if resolution is not None or window is not None:
+            return self._plot_window(variables, resolution, window, **kwargs)
 
-    def plot(self, variables: Tuple[str], **kwargs) -> 'sg.Graphics':
         # Add extra plotting arguments
         if 'step' not in kwargs:
             kwargs['step'] = 0.5
@@ -88,6 +547,68 @@ class VerifiedContinuousTrace(ContinuousTrace):
         )
         # type: ignore
 
+    def _window_boxes(self, window, step: float):
+        '''Boxes (as time intervals and enclosures) stepping through each
+        segment overlapping the window, clipped to the window.'''
+        starts, _, end_uppers = self._segment_index()
+        values = indexable(self.values)
+        k = bisect.bisect_left(end_uppers, window.lower())
+        while k < len(starts) and starts[k].lower() <= window.upper():
+            r = values[k]
+            start = starts[k]
+            a = max(0.0, float((window.lower() - start).lower()))
+            end = min(float(RIF(r.time).upper()),
+                      float((window.upper() - start).upper()))
+            while a < end:
+                b = min(a + step, end)
+                yield start + RIF(a, b), r(RIF(a, b))
+                a = b
+            k += 1
+
+    def _plot_window(self, variables: Tuple[str], resolution: Optional[int],
+                     window, step=0.5, **kwargs) -> 'sg.Graphics':
+        window = RIF(window) if window is not None else self.retained_domain
+        colors = kwargs.pop('color', ['blue']*len(variables))
+        for k in ['straight', 'joins']:
+            kwargs.pop(k, None)
+        vs = self.values[0].vs if len(self.values) else []
+        g = sg.Graphics()
+
+        if resolution is None:
+            # Full detail, with every box added to a single Graphics
+            for tt, y in self._window_boxes(window, step):
+                for v, col in zip(variables, colors):
+                    yv = y[vs.index(v)]
+                    g.add_primitive(sg.polygon(
+                        [(tt.lower(), yv.lower()), (tt.upper(), yv.lower()),
+                         (tt.upper(), yv.upper()), (tt.lower(), yv.upper())],
+                        color=col, **kwargs,
+                    )[0])
+            return g
+
+        edges = np.linspace(float(window.lower()), float(window.upper()),
+                            resolution + 1)
+        buckets = [RIF(a, b) for a, b in zip(edges, edges[1:])]
+        ys = self.batch(buckets)
+        for v, col in zip(variables, colors):
+            i = vs.index(v)
+            # One staircase polygon for each run of non-empty buckets
+            run : List[Tuple[float, float, float, float]] = []
+            for tt, y in itertools.chain(zip(buckets, ys), [(None, None)]):
+                if y is not None:
+                    run.append((tt.lower(), tt.upper(),
+                                y[i].lower(), y[i].upper()))
+                    continue
+                if run:
+                    upper = [p for a, b, _, hi in run
+                             for p in [(a, hi), (b, hi)]]
+                    lower = [p for a, b, lo, _ in reversed(run)
+                             for p in [(b, lo), (a, lo)]]
+                    g.add_primitive(sg.polygon(upper + lower, color=col,
+                                               **kwargs)[0])
+                    run = []
+        return g
+
     @staticmethod
     def interval_list_union(xs, ys):
         if not xs:
@@ -96,26 +617,98 @@ class VerifiedContinuousTrace(ContinuousTrace):
             return xs
         return [x.union(y) for x, y in zip(xs, ys)]
 
-    def __call__(self, t) -> RIF:
+    def _enclosure(self, t, values, index, k):
+        '''The enclosure at time t, scanning forwards from segment k, which
+        must not come after the first segment overlapping t.'''
+        starts, start_lowers, _ = index
         y = None
-        t0 = self.domain.edges()[0]
-        
-        for r in self.values:
-            print(f"")
-            if t.overlaps(t0 + RIF(0, r.time)): 
-                y = self.interval_list_union(r(t - t0), y)
-            t0 += RIF(r.time)
+
+        while k < len(starts) and start_lowers[k] <= t.upper():
+            r = values[k]
+            if t.overlaps(starts[k] + RIF(0, r.time)):
+                # Only evaluate the segment within its own domain
+                tt = (t - starts[k]).intersection(RIF(0, r.time))
+                y = self.interval_list_union(r(tt), y)
+            k += 1
 
         return y
 
+    def __call__(self, t) -> RIF:
+        t = RIF(t)
+        index = self._segment_index()
+        return self._enclosure(t, self.values, index,
+                               bisect.bisect_left(index[2], t.lower()))
+
+    def batch(self, ts) -> List[Optional[List[RIF]]]:
+        '''The enclosures at each of the time points or intervals in ts,
+        computed in a single sweep over the segments.'''
+        ts = [RIF(t) for t in ts]
+        index = self._segment_index()
+        end_uppers = index[2]
+        values = indexable(self.values)
+        ys : List[Optional[List[RIF]]] = [None]*len(ts)
+
+        # Visit the queries in order of their start time, so that the first
+        # overlapping segment only moves forwards
+        k = 0
+        for i in sorted(range(len(ts)), key=lambda i: ts[i].lower()):
+            while k < len(end_uppers) and end_uppers[k] < ts[i].lower():
+                k += 1
+            ys[i] = self._enclosure(ts[i], values, index, k)
+
+        return ys
+
 
 class NumericalContinuousTrace(ContinuousTrace):
-    def __init__(self, domain: RIF, values: Iterable[NumericalState]):
-        values = list(values)
+    def __init__(self, domain: RIF, values: Iterable[NumericalState],
+                 retention: Optional[Retention] = None):
         # assert all(isinstance(v, OdeSolution) for v in values)
-        super().__init__(domain, values)
+        self._index_key = None
+        super().__init__(domain, values, retention)
+
+    def _segment_index(self):
+        '''The dense output of each retained segment, together with the
+        absolute segment boundaries (the start of each segment followed by
+        the end of the last).'''
+        key = (self._n_evicted, len(self.values))
+        if self._index_key != key:
+            self._index_key = key
+            self._sols = [dense_output(v) for v in self.values]
+            self._boundaries = float(self.retained_start.lower()) + np.concatenate(
+                ([0.0], np.cumsum([sol.t_max - sol.t_min for sol in self._sols])))
+        return self._sols, self._boundaries
+
+    def evaluate(self, ts) -> np.ndarray:
+        '''The states at each of the absolute times ts as an array of shape
+        (n_times, n_vars), which is NaN outside of the trace.'''
+        sols, boundaries = self._segment_index()
+        n_vars = (np.atleast_1d(sols[0](sols[0].t_min)).shape[0]
+                  if sols else 0)
+        return evaluate_segments(ts, boundaries, n_vars,
+                                 partial(evaluate_dense_output, sols,
+                                         boundaries))
+
+    def _segment_duration(self, v) -> RIF:
+        return segment_duration(v)
+
+    def plot(self, variables: Tuple[int], resolution: Optional[int] = None,
+             window=None, **kwargs) -> 'sg.Graphics':
+        '''Plot each of the variables (given by index) over time. Given a
+        resolution or window, the trace is sampled at resolution (by default
+        1000) evenly spaced times across the window, and each variable is
+        drawn as a single line.'''
+        if resolution is not None or window is not None:
+            window = RIF(window) if window is not None else self.retained_domain
+            ts = np.linspace(float(window.lower()), float(window.upper()),
+                             resolution if resolution is not None else 1000)
+            ys = self.evaluate(ts)
+            inside = ~np.isnan(ys).all(axis=1)
+            g = sg.Graphics()
+            for i in variables:
+                g.add_primitive(sg.line(
+                    list(zip(ts[inside], ys[inside, i])), **kwargs)[0])
+            return g
 
-    def plot(self, variables: Tuple[int], **kwargs) -> 'sg.Graphics':
         var_fn = lambda r, i, t: r.sol(t - self.domain.lower())[i]
 
         return sum(
@@ -129,26 +722,138 @@ class NumericalContinuousTrace(ContinuousTrace):
             sg.Graphics(),
         )
 
-    def __call__(self, t) -> Optional[float]:
+    def __call__(self, t) -> Optional[np.ndarray]:
         if t not in self.domain:
             return None
 
-        for sol in self.values:
-            y = sol.sol(t)
-            if y is not None:
-                return y
-        
-        return None
+        y = self.evaluate([t])[0]
+        return None if np.isnan(y).all() else y
 
 
 class HybridTrace(RealTimeTrace):
-    @abc.abstractproperty
-    def continuous_part(self) -> ContinuousTrace:
+    '''A trace of discrete states interleaved with the continuous segments
+    which they govern.
+
+    An index of the positions of the segments and states, the start time of
+    each segment and the state governing it is built as the values are
+    read, and extended as values are streamed in (it is rebuilt after
+    evictions). The continuous and discrete parts are views of the values
+    using this index.'''
+
+    def __init__(self, domain: RIF, values,
+                 retention: Optional[Retention] = None):
+        self._hybrid_index_evicted = None
+        super().__init__(domain, values, retention)
+
+    @abc.abstractmethod
+    def _is_segment(self, v) -> bool:
         raise NotImplementedError()
 
+    @abc.abstractmethod
+    def _continuous_trace(self, values) -> ContinuousTrace:
+        raise NotImplementedError()
+
+    def _hybrid_index(self):
+        if self._hybrid_index_evicted != self._n_evicted:
+            self._hybrid_index_evicted = self._n_evicted
+            self._indexed = 0
+            self._next_start = self.retained_start
+            self._segment_positions : List[int] = []
+            self._state_positions : List[int] = []
+            # The index of the discrete state governing each segment
+            self._segment_states : List[int] = []
+            self._segment_starts : List[RIF] = []
+            self._segment_start_lowers : List[float] = []
+            # The time at which each discrete state was entered
+            self._state_time_lowers : List[float] = []
+            self._parts = None
+
+        if len(self.values) > self._indexed:
+            values = self.values
+            # Positions are kept in the whole run, so that views of the
+            # values stay valid after evictions
+            for i, v in enumerate(values[self._indexed:],
+                                  self._indexed + self._n_evicted):
+                if self._is_segment(v):
+                    self._segment_positions.append(i)
+                    self._segment_states.append(self._index_events(i, v))
+                    self._segment_starts.append(self._next_start)
+                    self._segment_start_lowers.append(
+                        float(self._next_start.lower()))
+                    self._next_start += self._segment_duration(v)
+                else:
+                    self._state_positions.append(i)
+                    self._state_time_lowers.append(
+                        float(self._next_start.lower()))
+            self._indexed = len(values)
+
+    def _index_events(self, i: int, v) -> int:
+        '''Time the discrete states entered during the segment v at position
+        i, which precede it, from their offsets within it, and return the
+        index of the state governing the start of the segment.'''
+        events = segment_events(v)
+        positions = self._state_positions
+        # Some of the states may have been evicted
+        n = 0
+        while (n < min(len(events), len(positions))
+               and positions[-1 - n] >= i - len(events)):
+            n += 1
+        n_at_start = 0
+        for j, (offset, _) in enumerate(events[len(events) - n:]):
+            k = len(positions) - n + j
+            self._state_time_lowers[k] = float(
+                (self._next_start + offset).lower())
+            if RIF(offset).upper() <= 0:
+                n_at_start += 1
+        return len(positions) - n - 1 + n_at_start
+
+    def _value_at(self, p: int):
+        # The value at position p of the whole run
+        return self.values[p - self._n_evicted]
+
+    def _views(self):
+        self._hybrid_index()
+        if self._parts is None:
+            continuous = SequenceView(self.values, self._segment_positions)
+            discrete = SequenceView(self.values, self._state_positions)
+            self._parts = (self._continuous_trace(continuous),
+                           DiscreteTrace(discrete))
+        return self._parts
+
+    @property
+    def continuous_part(self) -> ContinuousTrace:
+        return self._views()[0]
+
     @property
     def discrete_part(self) -> DiscreteTrace:
-        return DiscreteTrace(v for v in self if isinstance(v, dict))
+        return self._views()[1]
+
+    def segment_start(self, k: int) -> RIF:
+        self._hybrid_index()
+        return self._segment_starts[k]
+
+    def state_for_segment(self, k: int) -> Optional[dict]:
+        '''The discrete state which governs the start of continuous segment
+        k, i.e. the last one entered at or before its start.'''
+        self._hybrid_index()
+        i = self._segment_states[k]
+        return None if i < 0 else self._value_at(self._state_positions[i])
+
+    def segment_at(self, t) -> Optional[int]:
+        '''The index of the continuous segment active at the start of the
+        time (interval) t.'''
+        self._hybrid_index()
+        k = bisect.bisect_right(self._segment_start_lowers,
+                                float(RIF(t).lower())) - 1
+        return None if k < 0 else k
+
+    def state_at(self, t) -> Optional[dict]:
+        '''The discrete state active at the start of the time (interval) t,
+        i.e. the last one entered at or before it.'''
+        self._hybrid_index()
+        i = bisect.bisect_right(self._state_time_lowers,
+                                float(RIF(t).lower())) - 1
+        return None if i < 0 else self._value_at(self._state_positions[i])
 
     def plot(self, variables: Tuple[str], **kwargs) -> 'sg.Graphics':
         return self.continuous_part.plot(variables, **kwargs)
@@ -158,28 +863,64 @@ class HybridTrace(RealTimeTrace):
 
 
 class VerifiedHybridTrace(HybridTrace):
-    def __init__(self, domain: RIF, values: Iterable[VerifiedHybridState]):
-        values = list(values)
-        assert all(isinstance(v, (lbuc.Reach, dict)) for v in values)
-        super().__init__(domain, values)
+    def __init__(self, domain: RIF, values: Iterable[VerifiedHybridState],
+                 retention: Optional[Retention] = None):
+        super().__init__(domain, values, retention)
 
-    @property
-    def continuous_part(self) -> VerifiedContinuousTrace:
-        return VerifiedContinuousTrace(
-            self.domain,
-            (v for v in self if isinstance(v, lbuc.Reach)),
-        )
+    def _check_value(self, v):
+        assert isinstance(v, (ReachSegment, dict))
+
+    def _segment_duration(self, v) -> RIF:
+        return RIF(0) if isinstance(v, dict) else RIF(v.time)
+
+    def _is_segment(self, v) -> bool:
+        return isinstance(v, ReachSegment)
+
+    def _continuous_trace(self, values) -> VerifiedContinuousTrace:
+        return VerifiedContinuousTrace(self.retained_domain, values)
 
 
 class NumericalHybridTrace(HybridTrace):
-    def __init__(self, domain: RIF, values: Iterable[NumericalHybridState]):
-        values = list(values)
-        assert all(isinstance(v, (OdeSolution, dict)) for v in values)
-        super().__init__(domain, values)
+    def __init__(self, domain: RIF, values: Iterable[NumericalHybridState],
+                 retention: Optional[Retention] = None):
+        super().__init__(domain, values, retention)
 
-    @property
-    def continuous_part(self) -> NumericalContinuousTrace:
-        return NumericalContinuousTrace(
-            self.domain,
-            (v for v in self if isinstance(v, OdeSolution)),
-        )
\ No newline at end of file
+    def _check_value(self, v):
+        assert isinstance(v, (OdeSolution, dict))
+
+    def _segment_duration(self, v) -> RIF:
+        return segment_duration(v) if is_numerical_segment(v) else RIF(0)
+
+    def _is_segment(self, v) -> bool:
+        return is_numerical_segment(v)
+
+    def _continuous_trace(self, values) -> NumericalContinuousTrace:
+        return NumericalContinuousTrace(self.retained_domain, values)
+
+
+class VerifiedUnionTrace(ContinuousTrace):
+    '''The union of several verified traces over the same time domain, such
+    as the traces of the sub-boxes of a subdivided initial set.'''
+
+    def __init__(self, domain: RIF, traces: Iterable[RealTimeTrace]):
+        super().__init__(domain, (
+            t.continuous_part if isinstance(t, HybridTrace) else t
+            for t in traces
+        ))
+
+    def plot(self, variables: Tuple[str], **kwargs) -> 'sg.Graphics':
+        return sum((t.plot(variables, **kwargs) for t in self), sg.Graphics())
+
+    def __call__(self, t) -> Optional[List[RIF]]:
+        y = None
+        for trace in self:
+            y = VerifiedContinuousTrace.interval_list_union(trace(t), y)
+        return y
+
+    def batch(self, ts) -> List[Optional[List[RIF]]]:
+        ts = list(ts)
+        ys : List[Optional[List[RIF]]] = [None]*len(ts)
+        for trace in self:
+            ys = [VerifiedContinuousTrace.interval_list_union(y, y_acc)
+                  for y, y_acc in zip(trace.batch(ts), ys)]
+        return ys